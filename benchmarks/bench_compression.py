@@ -0,0 +1,67 @@
+'''
+Compression benchmark for laserscan.framestore.
+
+Writes synthetic 16 bit PSF frames with sensor-like noise through
+FrameStore for each codec and transform, verifies a round trip and
+reports the compression ratio and throughput. Compare MB/s with the
+acquisition data rate (frame size x frame rate) to choose settings.
+
+Run from the repository root:
+    python benchmarks/bench_compression.py [frames] [height] [width]
+'''
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from laserscan.framestore import FrameStore, FrameReader  # noqa: E402
+
+SETTINGS = (('zlib', 1, 'none'),
+            ('zlib', 1, 'shuffle'),
+            ('zlib', 1, 'delta'),
+            ('zlib', 1, 'delta+shuffle'),
+            ('zlib', 6, 'delta+shuffle'),
+            ('lzma', 0, 'delta+shuffle'))
+
+
+def synthetic_frames(n, height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.indices((height, width))
+    frames = np.empty((n, height, width), dtype=np.uint16)
+    for i in range(n):
+        r0 = height / 2 + 5 * np.sin(i / 10)
+        c0 = width / 2 + i % 20
+        psf = 8000 * np.exp(-((rows - r0) ** 2 + (cols - c0) ** 2) / 18.0)
+        frames[i] = 1200 + psf + rng.normal(0, 3, (height, width))
+    return frames
+
+
+def main(n=200, height=512, width=640):
+    frames = synthetic_frames(n, height, width)
+    mb = frames.nbytes / 1e6
+    print('%d frames %dx%d, %.1f MB' % (n, height, width, mb))
+    print('%-6s %5s %-14s %8s %10s' % ('codec', 'level', 'transform', 'ratio',
+                                       'MB/s'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec, level, transform in SETTINGS:
+            path = os.path.join(tmp, '%s_%d_%s' % (codec, level, transform))
+            store = FrameStore(path, (height, width), np.uint16, codec=codec,
+                               level=level, transform=transform)
+            start = time.perf_counter()
+            for i, frame in enumerate(frames):
+                store.write_frame(frame, key=i)
+            store.close()
+            elapsed = time.perf_counter() - start
+            reader = FrameReader(path)
+            for i in (0, n // 2, n - 1):
+                if not np.array_equal(reader.read(i), frames[i]):
+                    raise Exception('Round trip failed for %s' % path)
+            print('%-6s %5d %-14s %8.2f %10.1f' % (
+                codec, level, transform, store.stats()['ratio'], mb / elapsed))
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:4]))
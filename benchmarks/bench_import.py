@@ -0,0 +1,82 @@
+'''
+Import time benchmark for the laserscan package.
+
+Each module is imported in a fresh interpreter with '-X importtime' and
+the cumulative time of its top level import is reported. The benchmark
+also checks that heavy libraries and the Xeneth DLL are not loaded at
+import time, so it runs on machines without the camera runtime.
+
+Run from the repository root:
+    python benchmarks/bench_import.py [repeats]
+'''
+
+import os
+import re
+import subprocess
+import sys
+
+MODULES = ('laserscan.xevacam.xevadll',
+           'laserscan.xevacam.utils',
+           'laserscan.xevacam.camera',
+           'laserscan.aux_funcs',
+           'laserscan.lasercontrol',
+           'laserscan.gui')
+
+# Must not be imported as a side effect of importing laserscan modules
+HEAVY = ('matplotlib', 'pandas', 'pylab')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHECK = '''
+import sys, {module}
+import laserscan.xevacam.xevadll as xdll
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print('HEAVY', ','.join(heavy))
+print('DLL', xdll.XDLL.is_loaded())
+'''
+
+
+def import_time(module):
+    '''
+    @return: (cumulative import time in us, stdout, stderr)
+    '''
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         CHECK.format(module=module, heavy=HEAVY)],
+        cwd=ROOT, capture_output=True, text=True)
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        m = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)$', line)
+        if m and m.group(2) == module:
+            cumulative = int(m.group(1))
+    return cumulative, proc.stdout, proc.stderr if proc.returncode else ''
+
+
+def main(repeats=5):
+    failed = False
+    print('%-28s %12s  %s' % ('module', 'best [ms]', 'notes'))
+    for module in MODULES:
+        times = []
+        notes = ''
+        for _ in range(repeats):
+            t, out, err = import_time(module)
+            if err:
+                # Missing optional dependency (e.g. customtkinter)
+                notes = err.strip().splitlines()[-1]
+                break
+            times.append(t)
+            for line in out.splitlines():
+                key, _, value = line.partition(' ')
+                if key == 'HEAVY' and value:
+                    notes = 'imports %s' % value
+                    failed = True
+                elif key == 'DLL' and value == 'True':
+                    notes = 'loads the Xeneth DLL'
+                    failed = True
+        best = '%.1f' % (min(times) / 1000) if times else '-'
+        print('%-28s %12s  %s' % (module, best, notes))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5))
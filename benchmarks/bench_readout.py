@@ -0,0 +1,123 @@
+'''
+Frame readout benchmark.
+
+Compares the ways of reading a frame from the DLL and turning it into
+the int16 frame used by aux_funcs.capture_and_save_image():
+
+  - the numpy unpacking of buffer2frame(), astype() against a plain copy
+    of a same width view, on synthetic frames (always runs)
+  - XC_GetFrame with FT_NATIVE and XGF_NoConversion (the default readout
+    without software correction, see XevaCam.get_readout()), the native
+    type requested explicitly (the readout with software correction),
+    and DLL conversions to FT_16_BPP_GRAY and FT_32_BPP_GRAY
+    (with --camera, needs the camera and the Xeneth runtime)
+
+The unpacking variants must give the same values as astype(). Camera
+frames differ by noise, so each readout variant reports its correlation
+with the native frame instead.
+
+Run from the repository root:
+    python benchmarks/bench_readout.py [--camera cam://0] [--frames 200]
+'''
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from laserscan.aux_funcs import buffer2frame  # noqa: E402
+
+
+def timeit(func, repeats):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_unpack(repeats=200, height=512, width=640):
+    rng = np.random.default_rng(0)
+    # Full 16 bit range, values above 32767 must wrap like astype()
+    raw = rng.integers(0, 2 ** 16, (height, width), dtype=np.uint16)
+    buffer = raw.tobytes()
+    params = {'dtype': np.uint16, 'size': raw.nbytes, 'pixel': 2,
+              'dims': (height, width)}
+
+    def astype():
+        return np.frombuffer(buffer, dtype=np.uint16).reshape(
+            height, width).astype(np.int16)
+
+    def current():
+        return buffer2frame(buffer, **params)
+
+    reference = astype()
+    if not np.array_equal(current(), reference):
+        raise Exception('buffer2frame differs from astype(np.int16)')
+    print('Unpacking %dx%d uint16 frames' % (height, width))
+    for name, func in (('astype(np.int16)', astype),
+                       ('buffer2frame', current)):
+        print('  %-20s %8.1f us' % (name, 1e6 * timeit(func, repeats)))
+
+
+def bench_camera(camera_path, frames):
+    import laserscan.xevacam.xevadll as xdll
+    from laserscan.xevacam.camera import XevaCam
+    X = xdll.XDLL
+
+    cam = XevaCam()
+    cam.open(camera_path)
+    try:
+        cam.capture_frame_only()  # Starts capturing
+        native = cam.get_frame_type()
+        dims = cam._raw_frame_dims()
+        variants = (('FT_NATIVE + XGF_NoConversion', X.FT_NATIVE, X.XGF_NoConversion),
+                    ('native type, converting', native, 0),
+                    ('FT_16_BPP_GRAY', X.FT_16_BPP_GRAY, 0),
+                    ('FT_32_BPP_GRAY', X.FT_32_BPP_GRAY, 0))
+        print('Camera %s, native frame type %d, %dx%d' % (
+            camera_path, native, dims[0], dims[1]))
+        reference = None
+        for name, frame_t, flag in variants:
+            pixel = X.pixel_sizes[native if frame_t == X.FT_NATIVE else frame_t]
+            size = dims[0] * dims[1] * pixel
+            buffer = bytes(size)
+            dtype = {1: np.uint8, 2: np.uint16, 4: np.uint32}[pixel]
+            try:
+                cam.get_frame(buffer, frame_t, size, X.XGF_Blocking | flag)
+            except Exception as e:
+                print('  %-30s not supported: %s' % (name, str(e)))
+                continue
+            # Correctness: same scene, values must correlate with native
+            frame = np.frombuffer(buffer, dtype=dtype).astype(np.float64)
+            if reference is None:
+                reference = frame
+            corr = np.corrcoef(reference, frame)[0, 1] if frame.std() else 0.0
+            # Wall time is bound by the frame rate, CPU time shows the
+            # cost of the conversion
+            start, cpu = time.perf_counter(), time.thread_time()
+            for _ in range(frames):
+                cam.get_frame(buffer, frame_t, size, X.XGF_Blocking | flag)
+            elapsed = (time.perf_counter() - start) / frames
+            cpu = (time.thread_time() - cpu) / frames
+            print('  %-30s %8.2f ms/frame %8.2f ms CPU  correlation %.3f' % (
+                name, 1e3 * elapsed, 1e3 * cpu, corr))
+    finally:
+        cam.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--camera', default=None,
+                        help='Camera URL, e.g. cam://0, for DLL readout timings')
+    parser.add_argument('--frames', type=int, default=200)
+    args = parser.parse_args(argv)
+    bench_unpack()
+    if args.camera:
+        bench_camera(args.camera, args.frames)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,40 +1,86 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 import os
+import re
 import time
 
+# File names written by capture_and_save_image()
+CAPTURE_NAME = re.compile(r'image_(?P<wavelength>[-\d.]+)nm_(?P<integration>[-\d.]+)us\.csv$')
+
 def buffer2frame(frame_buffer, **kwargs):
     '''Convert the buffer raw data collected by the camera into a
     two-dimensional image matrix.'''
-    return np.frombuffer(
+    frame = np.frombuffer(
         frame_buffer,
         dtype=kwargs["dtype"],
         count=int(kwargs["size"] / kwargs["pixel"])
-    ).reshape(kwargs["dims"]).astype(np.int16)
+    ).reshape(kwargs["dims"])
+    if frame.dtype.itemsize == 2:
+        # Same width, a plain copy gives the same values as astype()
+        return frame.view(np.int16).copy()
+    return frame.astype(np.int16)
 
 
-def capture_and_save_image(c, wavelength_nm, integration_time_us, output_dir):
+def capture_and_save_image(c, wavelength_nm, integration_time_us, output_dir,
+                           corrector=None, bad_pixels=None, psf_table=None,
+                           background=None, frame_store=None, group=None):
     '''
     Call the camera to acquire images and save them as CSV files.
+    A prepared correction.FrameCorrector applies dark and flat correction,
+    a badpixels.BadPixelCorrector replaces bad pixels, a psf.PSFTable
+    records the PSF metrics of the frame and a
+    background.InterleavedBackground keeps a background subtracted copy.
+    The CSV file always holds the raw frame; when bad pixel or dark/flat
+    correction is applied, the corrected frame is saved next to it as
+    <name>_corrected.npy. Backgrounds already contain the dark signal, so
+    the background subtraction gets the raw frame as well.
+    A framestore.FrameStore keeps a lossless compressed copy of the raw
+    sensor frame, in the camera's pixel dtype, keyed by wavelength.
+    With a xevacam.group.CameraGroup whose primary camera is c, the other
+    cameras of the group capture at the same time into their own stores.
     '''
-    
+    # Plotting and dataframe libraries are slow to import, load on use
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
     params = c.get_frame_parameters()
 
     c.set_property(integration_time_us, name="IntegrationTime")
     time.sleep(0.2)
-    for _ in range(10):  
-        c.capture_frame_only()
+    if group is not None:
+        frames = group.capture(key=wavelength_nm, flush=10)
+        frame = frames[group.primary][0]
+    else:
+        for _ in range(10):
+            c.capture_frame_only()
 
-    frame, *_ = c.capture_frame_only()
-    captured_frame = buffer2frame(frame, **params)
+        frame, *_ = c.capture_frame_only()
+    raw_frame = buffer2frame(frame, **params)
+    captured_frame = raw_frame
+    if bad_pixels is not None:
+        captured_frame = raw_frame.copy()
+        bad_pixels.apply(captured_frame)
+    if corrector is not None:
+        captured_frame = corrector.apply(captured_frame)
+    if psf_table is not None:
+        psf_table.add(wavelength_nm, captured_frame)
 
     base_name = f"image_{wavelength_nm:.2f}nm_{integration_time_us}us"
+    if background is not None:
+        background.add_signal(base_name, raw_frame)
+    if frame_store is not None:
+        sensor_frame = np.frombuffer(
+            frame, dtype=params["dtype"],
+            count=int(params["size"] / params["pixel"])).reshape(params["dims"])
+        frame_store.write_frame(sensor_frame, key=wavelength_nm)
+    record_fingerprint(c, base_name, output_dir)
     csv_path = os.path.join(output_dir, f"{base_name}.csv")
     png_path = os.path.join(output_dir, f"{base_name}.png")
 
-    pd.DataFrame(captured_frame).to_csv(csv_path, index=False)
+    pd.DataFrame(raw_frame).to_csv(csv_path, index=False)
     print(f"Saved CSV: {csv_path}")
+    if captured_frame is not raw_frame:
+        np.save(os.path.join(output_dir, f"{base_name}_corrected.npy"),
+                captured_frame)
 
     log_data = np.log1p(captured_frame)
     plt.figure(figsize=(7, 5))
@@ -45,4 +91,49 @@ def capture_and_save_image(c, wavelength_nm, integration_time_us, output_dir):
     plt.savefig(png_path)
     plt.close()  
     print(f"Saved image: {png_path}")
-    return csv_path
\ No newline at end of file
+    return csv_path
+
+
+def parse_capture_name(filename):
+    '''
+    Parses wavelength and integration time from a capture file name,
+    e.g. 'image_1530.00nm_5000.0us.csv'.
+    @return: (wavelength_nm, integration_time_us), or None if no match
+    '''
+    m = CAPTURE_NAME.search(os.path.basename(filename))
+    if m is None:
+        return None
+    return float(m.group('wavelength')), float(m.group('integration'))
+
+
+def list_captures(folder):
+    '''
+    Lists the capture CSV files of a captures folder.
+    @return: List of (wavelength_nm, integration_time_us, path), sorted by
+             wavelength
+    '''
+    captures = []
+    for name in os.listdir(folder):
+        parsed = parse_capture_name(name)
+        if parsed is not None:
+            captures.append(parsed + (os.path.join(folder, name),))
+    captures.sort()
+    return captures
+
+
+def record_fingerprint(c, base_name, output_dir):
+    '''
+    Appends the fingerprint of the latest captured frame to
+    fingerprints.csv, flagging frames that repeat a previous one.
+    '''
+    fp = getattr(c, 'last_fingerprint', None)
+    if fp is None:
+        return
+    if c.last_frame_duplicate:
+        print(f"Warning: {base_name} repeats a previous frame")
+    path = os.path.join(output_dir, "fingerprints.csv")
+    new = not os.path.exists(path)
+    with open(path, 'a') as f:
+        if new:
+            f.write("name,fingerprint,repeated\n")
+        f.write(f"{base_name},{fp:016x},{int(c.last_frame_duplicate)}\n")
@@ -0,0 +1,147 @@
+'''
+Interleaved laser-off background frames.
+
+During a sweep a background is captured with the laser output off every
+N wavelengths. Each signal frame is corrected with the background
+linearly interpolated in time between the backgrounds before and after
+it, which removes slow drift (thermal changes, stray light). Signal
+frames wait in memory until their following background arrives and are
+then corrected together in one vectorized operation.
+
+Raw frames are kept as written by capture_and_save_image(); backgrounds
+and corrected frames are written as .npy files next to them, and
+background_log.csv records the capture times.
+
+Backgrounds include the dark signal, so use raw frames here instead of
+frames already corrected by correction.FrameCorrector.
+
+Toggling is kept cheap: the output is switched with write-only commands,
+and the caller can pass the wavelength step to capture_background() so
+that the laser settles and steps at the same time.
+'''
+
+import csv
+import os
+import time
+import numpy as np
+
+from laserscan.correction import average_frames
+
+
+class InterleavedBackground(object):
+
+    def __init__(self, output_dir, every=5, settle=0.5, n_frames=4):
+        '''
+        @param output_dir: Directory for backgrounds and corrected frames
+        @param every: Signal frames between backgrounds
+        @param settle: Seconds to wait after switching the laser output
+        @param n_frames: Frames averaged per background
+        '''
+        self.output_dir = output_dir
+        self.every = every
+        self.settle = settle
+        self.n_frames = n_frames
+        self._last = None  # (time, frame) of the latest background
+        self._pending = []  # (time, name, frame) waiting for a background
+        self._since = 0  # Signal frames since the latest background
+        self._count = 0
+        self._log_path = os.path.join(output_dir, 'background_log.csv')
+        if not os.path.exists(self._log_path):
+            with open(self._log_path, 'w', newline='') as f:
+                csv.writer(f).writerow(('time_s', 'kind', 'name'))
+
+    def due(self):
+        '''
+        @return: True if a background should be captured before the next
+                 signal frame
+        '''
+        return self._last is None or self._since >= self.every
+
+    def capture_background(self, cam, laser, params=None, step=None):
+        '''
+        Captures a background with the laser output off.
+
+        @param cam: XevaCam
+        @param laser: LaserSource
+        @param params: cam.get_frame_parameters()
+        @param step: Optional callable run while the output is off, e.g.
+                     stepping the wavelength, so its time overlaps the
+                     settle time
+        '''
+        laser.power = False
+        start = time.monotonic()
+        if step is not None:
+            step()
+        time.sleep(max(0.0, self.settle - (time.monotonic() - start)))
+        try:
+            t = time.monotonic()
+            frame = average_frames(cam, self.n_frames, params)
+            t = (t + time.monotonic()) / 2
+        finally:
+            laser.power = True
+        time.sleep(self.settle)
+        self.add_background(frame, t)
+
+    def add_background(self, frame, t=None):
+        '''
+        Registers a background and corrects the frames waiting for it.
+        '''
+        t = time.monotonic() if t is None else t
+        frame = np.asarray(frame, dtype=np.float32)
+        name = 'background_%03d' % self._count
+        self._count += 1
+        np.save(os.path.join(self.output_dir, name + '.npy'), frame)
+        self._log(t, 'background', name)
+        self._flush(self._last, (t, frame))
+        self._last = (t, frame)
+        self._since = 0
+
+    def add_signal(self, name, frame, t=None):
+        '''
+        Registers a signal frame. It is corrected when the next background
+        arrives, or by finish().
+
+        @param name: Base name of the frame, e.g. 'image_1530.00nm_5000us'
+        @param frame: Raw frame, copied
+        '''
+        t = time.monotonic() if t is None else t
+        self._pending.append((t, name, np.array(frame, dtype=np.float32)))
+        self._since += 1
+        self._log(t, 'signal', name)
+
+    def finish(self, cam=None, laser=None, params=None):
+        '''
+        Corrects the remaining frames, after capturing a closing background
+        if the camera and laser are given. Otherwise the latest background
+        is used as is.
+        '''
+        if not self._pending:
+            return
+        if cam is not None and laser is not None:
+            self.capture_background(cam, laser, params)
+        else:
+            self._flush(self._last, None)
+
+    def _flush(self, before, after):
+        # Corrects pending frames with the backgrounds interpolated in time
+        if not self._pending:
+            return
+        if before is None and after is None:
+            raise Exception('No background captured.')
+        times = np.array([p[0] for p in self._pending])
+        stack = np.stack([p[2] for p in self._pending])
+        if before is None or after is None:
+            background = (before or after)[1]
+            stack -= background
+        else:
+            (t0, bg0), (t1, bg1) = before, after
+            w = np.clip((times - t0) / (t1 - t0), 0.0, 1.0).astype(np.float32)
+            stack -= bg0
+            stack -= w[:, None, None] * (bg1 - bg0)
+        for (_, name, _), frame in zip(self._pending, stack):
+            np.save(os.path.join(self.output_dir, name + '_bgsub.npy'), frame)
+        self._pending = []
+
+    def _log(self, t, kind, name):
+        with open(self._log_path, 'a', newline='') as f:
+            csv.writer(f).writerow(('%.6f' % t, kind, name))
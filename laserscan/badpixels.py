@@ -0,0 +1,180 @@
+'''
+Bad pixel detection and correction.
+
+Hot pixels are outliers of the per-pixel temporal mean or variance of a
+dark stack, dead pixels respond far less than their neighbours in a flat
+stack. Bad pixels are replaced by the mean (or median) of their good
+neighbours. The neighbour indices are precomputed once, so correcting a
+frame costs a single gather over the bad pixels only.
+'''
+
+import numpy as np
+
+
+def capture_stack(cam, n_frames, params=None, discard=2):
+    '''
+    Captures consecutive frames.
+
+    @param cam: XevaCam
+    @param n_frames: Number of frames in the stack
+    @param params: cam.get_frame_parameters(), queried when None
+    @param discard: Frames dropped first, flushes stale frames
+    @return: ndarray (n_frames, height, width) of the camera dtype
+    '''
+    if params is None:
+        params = cam.get_frame_parameters()
+    for _ in range(discard):
+        cam.capture_frame_only()
+    stack = np.empty((n_frames,) + tuple(params['dims']), dtype=params['dtype'])
+    count = int(params['size'] / params['pixel'])
+    for i in range(n_frames):
+        frame_buffer, *_ = cam.capture_frame_only()
+        stack[i].reshape(-1)[:] = np.frombuffer(frame_buffer,
+                                                dtype=params['dtype'],
+                                                count=count)
+    return stack
+
+
+def _outliers(values, nsigma):
+    '''
+    Robust outliers: further than nsigma scaled MADs from the median.
+    '''
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    if mad == 0:
+        return values != median
+    return np.abs(values - median) > nsigma * mad
+
+
+def detect_bad_pixels(dark_stack, flat_stack=None, nsigma=6.0,
+                      dead_fraction=0.5):
+    '''
+    Builds a bad pixel mask.
+
+    @param dark_stack: (n, height, width) frames without illumination
+    @param flat_stack: Optional (n, height, width) uniformly illuminated
+                       frames
+    @param nsigma: Outlier threshold of the dark mean and variance
+    @param dead_fraction: Pixels responding less than this fraction of
+                          the median flat response are dead
+    @return: bool ndarray (height, width), True for bad pixels
+    '''
+    dark = np.asarray(dark_stack, dtype=np.float64)
+    dark_mean = dark.mean(axis=0)
+    mask = _outliers(dark_mean, nsigma)
+    if dark.shape[0] > 1:
+        mask |= _outliers(dark.var(axis=0), nsigma)
+    if flat_stack is not None:
+        response = np.asarray(flat_stack, dtype=np.float64).mean(axis=0) - dark_mean
+        median = np.median(response)
+        mask |= response < dead_fraction * median
+        mask |= _outliers(response, nsigma) & (response > median)
+    return mask
+
+
+class BadPixelCorrector(object):
+    '''
+    Replaces masked pixels with a statistic of their good neighbours.
+    '''
+
+    def __init__(self, mask, method='mean', radius=1):
+        '''
+        @param mask: bool ndarray, True for bad pixels
+        @param method: 'mean' or 'median' of the good neighbours
+        @param radius: Neighbourhood half width in pixels
+        '''
+        if method not in ('mean', 'median'):
+            raise Exception('Unknown bad pixel method %s' % str(method))
+        self.mask = np.asarray(mask, dtype=bool)
+        self.method = method
+        rows, cols = np.nonzero(self.mask)
+        height, width = self.mask.shape
+        self.bad_idx = rows * width + cols
+
+        offsets = [(dr, dc)
+                   for dr in range(-radius, radius + 1)
+                   for dc in range(-radius, radius + 1)
+                   if (dr, dc) != (0, 0)]
+        dr = np.array([o[0] for o in offsets])
+        dc = np.array([o[1] for o in offsets])
+        nr = rows[:, None] + dr[None, :]
+        nc = cols[:, None] + dc[None, :]
+        inside = (nr >= 0) & (nr < height) & (nc >= 0) & (nc < width)
+        nr = np.clip(nr, 0, height - 1)
+        nc = np.clip(nc, 0, width - 1)
+        self.nbr_idx = nr * width + nc
+        # Weight 1 for good neighbours inside the frame, 0 otherwise
+        self.weights = (inside & ~self.mask[nr, nc]).astype(np.float32)
+        self.weight_sum = self.weights.sum(axis=1)
+        # Pixels without good neighbours are left untouched
+        keep = self.weight_sum > 0
+        self.bad_idx = self.bad_idx[keep]
+        self.nbr_idx = self.nbr_idx[keep]
+        self.weights = self.weights[keep]
+        self.weight_sum = self.weight_sum[keep]
+        self._invalid = self.weights == 0
+
+    @property
+    def count(self):
+        return self.bad_idx.shape[0]
+
+    def apply(self, frame):
+        '''
+        Corrects a frame in place.
+
+        @param frame: Writeable C-contiguous ndarray with the mask shape
+        @return: frame
+        '''
+        if self.count == 0:
+            return frame
+        flat = frame.reshape(-1)
+        values = flat[self.nbr_idx]
+        if self.method == 'mean':
+            repl = (values * self.weights).sum(axis=1) / self.weight_sum
+        else:
+            values = values.astype(np.float32)
+            values[self._invalid] = np.nan
+            repl = np.nanmedian(values, axis=1)
+        flat[self.bad_idx] = repl
+        return frame
+
+    def save(self, cache, key):
+        '''
+        Stores the mask in a correction.MasterFrameCache.
+        '''
+        cache.save('badpix', key, self.mask, pixels=int(self.mask.sum()))
+
+    @classmethod
+    def load(cls, cache, key, dims=None, **kwargs):
+        '''
+        Loads a mask from a correction.MasterFrameCache.
+        @return: BadPixelCorrector, or None if no valid mask is cached
+        '''
+        mask = cache.load('badpix', key, dims)
+        if mask is None:
+            return None
+        return cls(mask, **kwargs)
+
+
+class BadPixelStream(object):
+    '''
+    Handler for XevaCam.set_handler() that corrects bad pixels of each
+    frame and writes it to another stream.
+    '''
+
+    def __init__(self, stream, corrector, params):
+        '''
+        @param stream: Output stream, e.g. XevaStream
+        @param corrector: BadPixelCorrector
+        @param params: cam.get_frame_parameters()
+        '''
+        self.stream = stream
+        self.corrector = corrector
+        self.params = params
+
+    def write(self, b):
+        # Copy, the buffer is shared with the other handlers
+        frame = np.frombuffer(b, dtype=self.params['dtype']).reshape(
+            self.params['dims']).copy()
+        self.corrector.apply(frame)
+        return self.stream.write(frame.data)
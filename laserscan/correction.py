@@ -0,0 +1,252 @@
+'''
+Dark frame and flat field correction.
+
+Master frames are averaged from a stack of captures and cached on disk
+per camera setting (IntegrationTime, LowGain), so that later sessions
+reuse them until the settings change or the masters get too old. Dark
+frames are captured with the laser output switched off through
+LaserSource.power.
+'''
+
+import json
+import os
+import time
+import numpy as np
+from laserscan.badpixels import BadPixelCorrector, capture_stack, \
+    detect_bad_pixels
+
+
+def settings_key(integration_time, lowgain):
+    '''
+    @return: str key of a camera setting, e.g. 'IT5000_LG1'
+    '''
+    return 'IT%g_LG%d' % (float(integration_time), int(lowgain))
+
+
+def average_frames(cam, n_frames, params=None, discard=2):
+    '''
+    Averages consecutive frames from the camera.
+
+    @param cam: XevaCam
+    @param n_frames: Number of frames averaged
+    @param params: cam.get_frame_parameters(), queried when None
+    @param discard: Frames dropped first, flushes stale frames
+    @return: float32 ndarray with the frame dimensions
+    '''
+    if params is None:
+        params = cam.get_frame_parameters()
+    for _ in range(discard):
+        cam.capture_frame_only()
+    acc = np.zeros(params['dims'], dtype=np.float64)
+    for _ in range(n_frames):
+        frame_buffer, *_ = cam.capture_frame_only()
+        frame = np.frombuffer(frame_buffer, dtype=params['dtype'],
+                              count=int(params['size'] / params['pixel']))
+        np.add(acc, frame.reshape(params['dims']), out=acc)
+    acc /= n_frames
+    return acc.astype(np.float32)
+
+
+class MasterFrameCache(object):
+    '''
+    Stores master frames as .npy files with a JSON metadata sidecar.
+    '''
+
+    def __init__(self, directory, max_age=24 * 3600):
+        '''
+        @param directory: Directory of the cache, created when missing
+        @param max_age: Seconds after which a master frame is not reused
+        '''
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, kind, key):
+        base = os.path.join(self.directory, '%s_%s' % (kind, key))
+        return base + '.npy', base + '.json'
+
+    def load(self, kind, key, dims=None):
+        '''
+        @param kind: 'dark' or 'flat'
+        @param key: settings_key()
+        @param dims: Expected frame dimensions, mismatch invalidates
+        @return: ndarray, or None if missing or invalid
+        '''
+        frame_path, meta_path = self._paths(kind, key)
+        if not (os.path.exists(frame_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if time.time() - meta['created'] > self.max_age:
+            print('MasterFrameCache', 'Expired %s master %s' % (kind, key))
+            return None
+        if dims is not None and tuple(meta['dims']) != tuple(dims):
+            return None
+        return np.load(frame_path)
+
+    def save(self, kind, key, frame, **meta):
+        '''
+        @param kind: 'dark' or 'flat'
+        @param key: settings_key()
+        @param frame: Master frame
+        @param meta: Extra metadata, e.g. number of averaged frames
+        '''
+        frame_path, meta_path = self._paths(kind, key)
+        np.save(frame_path, frame)
+        meta.update(created=time.time(), dims=list(frame.shape), key=key)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=1)
+
+
+class FrameCorrector(object):
+    '''
+    Subtracts the master dark, divides by the normalised flat field and
+    replaces bad pixels when a mask is cached for the setting.
+    '''
+
+    def __init__(self, cache, n_dark=32, n_flat=32, settle=0.2):
+        '''
+        @param cache: MasterFrameCache
+        @param n_dark: Frames averaged into a master dark
+        @param n_flat: Frames averaged into a master flat
+        @param settle: Seconds to wait after switching the laser
+        '''
+        self.cache = cache
+        self.n_dark = n_dark
+        self.n_flat = n_flat
+        self.settle = settle
+        self.key = None
+        self.dark = None
+        self.gain = None  # Reciprocal of the normalised flat
+        self.bad_pixels = None  # BadPixelCorrector, if a mask is cached
+        self._out = None
+
+    @property
+    def ready(self):
+        return self.dark is not None
+
+    def prepare(self, cam, laser, integration_time, lowgain):
+        '''
+        Applies the camera setting and loads its master frames, capturing a
+        new master dark if no valid one is cached.
+        '''
+        cam.set_properties([('LowGain', lowgain, 'bool'),
+                            ('IntegrationTime', integration_time, 'num')])
+        params = cam.get_frame_parameters()
+        self.key = settings_key(integration_time, lowgain)
+        self.dark = self.cache.load('dark', self.key, params['dims'])
+        if self.dark is None:
+            self.dark = self.capture_dark(cam, laser, params)
+        flat = self.cache.load('flat', self.key, params['dims'])
+        self.gain = None if flat is None else self._flat_gain(flat)
+        self.bad_pixels = BadPixelCorrector.load(self.cache, self.key,
+                                                 params['dims'])
+
+    def capture_dark(self, cam, laser, params=None):
+        '''
+        Captures and caches a master dark with the laser output off.
+        '''
+        was_on = laser.power
+        laser.power = False
+        try:
+            time.sleep(self.settle)
+            dark = average_frames(cam, self.n_dark, params)
+        finally:
+            if was_on:
+                laser.power = True
+                time.sleep(self.settle)
+        self.cache.save('dark', self.key, dark, frames=self.n_dark)
+        print('FrameCorrector', 'Captured master dark %s' % self.key)
+        return dark
+
+    def capture_flat(self, cam, params=None):
+        '''
+        Captures and caches a master flat. The sensor must be uniformly
+        illuminated, and the master dark prepared.
+        '''
+        if not self.ready:
+            raise Exception('Master dark is not prepared.')
+        flat = average_frames(cam, self.n_flat, params)
+        flat -= self.dark
+        self.cache.save('flat', self.key, flat, frames=self.n_flat)
+        self.gain = self._flat_gain(flat)
+        return flat
+
+    def capture_bad_pixels(self, cam, laser, n_frames=64, flat_stack=None,
+                           params=None):
+        '''
+        Detects bad pixels from a dark stack captured with the laser output
+        off, and an optional flat stack, and caches the mask.
+        @return: BadPixelCorrector
+        '''
+        if self.key is None:
+            raise Exception('Camera setting is not prepared.')
+        was_on = laser.power
+        laser.power = False
+        try:
+            time.sleep(self.settle)
+            dark_stack = capture_stack(cam, n_frames, params)
+        finally:
+            if was_on:
+                laser.power = True
+                time.sleep(self.settle)
+        self.bad_pixels = BadPixelCorrector(
+            detect_bad_pixels(dark_stack, flat_stack))
+        self.bad_pixels.save(self.cache, self.key)
+        print('FrameCorrector', 'Found %d bad pixels' % self.bad_pixels.count)
+        return self.bad_pixels
+
+    @staticmethod
+    def _flat_gain(flat):
+        # Multiplying by the reciprocal is cheaper than dividing each frame
+        gain = np.zeros_like(flat, dtype=np.float32)
+        valid = flat > 0
+        gain[valid] = flat[valid].mean() / flat[valid]
+        return gain
+
+    def apply(self, frame, out=None):
+        '''
+        Corrects a frame.
+
+        @param frame: Raw frame with the master frame dimensions
+        @param out: float32 output array. If None, an internal buffer is
+                    reused, so copy the result if it must be kept.
+        @return: Corrected float32 frame
+        '''
+        if not self.ready:
+            raise Exception('Master dark is not prepared.')
+        if out is None:
+            if self._out is None or self._out.shape != self.dark.shape:
+                self._out = np.empty(self.dark.shape, dtype=np.float32)
+            out = self._out
+        np.subtract(frame, self.dark, out=out, casting='unsafe')
+        if self.gain is not None:
+            np.multiply(out, self.gain, out=out)
+        if self.bad_pixels is not None:
+            self.bad_pixels.apply(out)
+        return out
+
+
+class CorrectionStream(object):
+    '''
+    Handler for XevaCam.set_handler() that corrects each frame and writes
+    it as float32 bytes to another stream.
+    '''
+
+    def __init__(self, stream, corrector, params):
+        '''
+        @param stream: Output stream, e.g. XevaStream
+        @param corrector: Prepared FrameCorrector
+        @param params: cam.get_frame_parameters()
+        '''
+        self.stream = stream
+        self.corrector = corrector
+        self.params = params
+
+    def write(self, b):
+        frame = np.frombuffer(b, dtype=self.params['dtype'],
+                              count=int(self.params['size'] / self.params['pixel']))
+        # New array per frame, since queued streams keep a reference
+        out = np.empty(self.params['dims'], dtype=np.float32)
+        self.corrector.apply(frame.reshape(self.params['dims']), out=out)
+        return self.stream.write(out.data)
@@ -0,0 +1,271 @@
+'''
+Batch PSF model fitting over a wavelength cube.
+
+Frames are placed once in a multiprocessing.shared_memory block, worker
+processes attach to it and receive only (index, seed) tasks, so frames
+are never pickled. Each fit is a Levenberg-Marquardt least squares fit
+on a window around the peak, seeded from the moment estimate of the
+previous wavelength (see psf.psf_metrics). Seeds are computed up front,
+so the frames stay independent and can be fitted in parallel.
+
+Worker processes are spawned on Windows, so call fit_cube() from a script
+guarded by `if __name__ == '__main__':`.
+
+Example:
+    table = fit_cube(cube, wavelengths, model='gaussian')
+    save_fit_table(table, os.path.join(folder, 'psf_fits.csv'))
+'''
+
+import concurrent.futures
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+from laserscan.psf import psf_metrics
+from laserscan.aux_funcs import list_captures
+from laserscan import convert
+
+# Parameter names of the models
+PARAMS = {'gaussian': ('amplitude', 'row', 'col', 'sigma_row', 'sigma_col',
+                       'offset'),
+          'airy': ('amplitude', 'row', 'col', 'scale', 'offset')}
+
+
+def bessel_j1(x):
+    '''
+    Bessel function of the first kind of order one, rational and
+    asymptotic approximations with |error| < 1e-8.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    ax = np.abs(x)
+    out = np.empty_like(ax)
+    small = ax < 8.0
+    y = x[small] ** 2
+    out[small] = x[small] * (72362614232.0 + y * (-7895059235.0 + y * (
+        242396853.1 + y * (-2972611.439 + y * (15704.48260 + y * (
+            -30.16036606)))))) / (144725228442.0 + y * (2300535178.0 + y * (
+                18583304.74 + y * (99447.43394 + y * (376.9991397 + y)))))
+    big = ~small
+    z = 8.0 / ax[big]
+    y = z ** 2
+    xx = ax[big] - 2.356194491
+    p1 = 1.0 + y * (0.183105e-2 + y * (-0.3516396496e-4 + y * (
+        0.2457520174e-5 + y * (-0.240337019e-6))))
+    p2 = 0.04687499995 + y * (-0.2002690873e-3 + y * (0.8449199096e-5 + y * (
+        -0.88228987e-6 + y * 0.105787412e-6)))
+    out[big] = np.sqrt(0.636619772 / ax[big]) * (np.cos(xx) * p1 - z * np.sin(xx) * p2)
+    out[big] *= np.sign(x[big])
+    return out
+
+
+def gaussian_model(p, rows, cols):
+    a, r0, c0, sr, sc, b = p
+    return a * np.exp(-0.5 * (((rows - r0) / sr) ** 2 + ((cols - c0) / sc) ** 2)) + b
+
+
+def airy_model(p, rows, cols):
+    a, r0, c0, k, b = p
+    v = k * np.sqrt((rows - r0) ** 2 + (cols - c0) ** 2)
+    v = np.where(v < 1e-8, 1e-8, v)
+    return a * (2.0 * bessel_j1(v) / v) ** 2 + b
+
+
+MODELS = {'gaussian': gaussian_model, 'airy': airy_model}
+
+
+def levenberg_marquardt(model, p0, rows, cols, data, max_iter=50, tol=1e-8):
+    '''
+    Least squares fit with a finite difference Jacobian.
+    @return: (parameters, residual rms, iterations, converged)
+    '''
+    p = np.array(p0, dtype=np.float64)
+    r = data - model(p, rows, cols)
+    cost = r @ r
+    lam = 1e-3
+    J = np.empty((data.size, p.size))
+    for it in range(1, max_iter + 1):
+        m = data - r
+        for k in range(p.size):
+            dp = 1e-6 * max(abs(p[k]), 1e-3)
+            q = p.copy()
+            q[k] += dp
+            J[:, k] = (model(q, rows, cols) - m) / dp
+        A = J.T @ J
+        g = J.T @ r
+        diag = np.diag(A).copy()
+        while True:
+            try:
+                step = np.linalg.solve(A + lam * np.diag(diag), g)
+            except np.linalg.LinAlgError:
+                step = None
+            if step is not None:
+                r_new = data - model(p + step, rows, cols)
+                cost_new = r_new @ r_new
+                if np.isfinite(cost_new) and cost_new < cost:
+                    break
+            lam *= 10.0
+            if lam > 1e12:
+                # No step improves the fit, p is a minimum
+                return p, np.sqrt(cost / data.size), it, bool(np.isfinite(cost))
+        p += step
+        converged = cost - cost_new <= tol * cost
+        r, cost = r_new, cost_new
+        lam = max(lam / 10.0, 1e-12)
+        if converged:
+            return p, np.sqrt(cost / data.size), it, True
+    return p, np.sqrt(cost / data.size), max_iter, False
+
+
+def moment_seed(frame, model, window):
+    '''
+    Initial parameters from the moments of a frame.
+    '''
+    m = psf_metrics(frame, window, radii=())
+    sr = m['sigma_row'] if np.isfinite(m['sigma_row']) and m['sigma_row'] > 0 else 2.0
+    sc = m['sigma_col'] if np.isfinite(m['sigma_col']) and m['sigma_col'] > 0 else 2.0
+    amplitude = m['peak'] - m['background']
+    row = m['centroid_row'] if np.isfinite(m['centroid_row']) else m['peak_row']
+    col = m['centroid_col'] if np.isfinite(m['centroid_col']) else m['peak_col']
+    if model == 'gaussian':
+        return np.array([amplitude, row, col, sr, sc, m['background']])
+    # (2 J1(v) / v)^2 ~ exp(-v^2 / 4), i.e. sigma = sqrt(2) / scale
+    return np.array([amplitude, row, col, np.sqrt(2) / np.sqrt(sr * sc),
+                     m['background']])
+
+
+def fit_frame(frame, model='gaussian', seed=None, window=16):
+    '''
+    Fits a PSF model on a window around the peak of a frame.
+
+    @param frame: 2D ndarray
+    @param model: 'gaussian' or 'airy'
+    @param seed: Initial parameters, moments of the frame when None
+    @param window: Half width of the fitted window
+    @return: (parameters in frame coordinates, residual rms, iterations,
+              converged)
+    '''
+    frame = np.asarray(frame)
+    if seed is None:
+        seed = moment_seed(frame, model, window)
+    peak = np.unravel_index(np.argmax(frame), frame.shape)
+    r0 = max(peak[0] - window, 0)
+    c0 = max(peak[1] - window, 0)
+    data = frame[r0:peak[0] + window + 1,
+                 c0:peak[1] + window + 1].astype(np.float64)
+    rows, cols = np.indices(data.shape, dtype=np.float64)
+    p0 = np.array(seed, dtype=np.float64)
+    p0[1] -= r0
+    p0[2] -= c0
+    p, rms, it, ok = levenberg_marquardt(MODELS[model], p0, rows.ravel(),
+                                         cols.ravel(), data.ravel())
+    p[1] += r0
+    p[2] += c0
+    return p, rms, it, ok
+
+
+# Shared memory cube of a worker process
+_worker = {}
+
+
+def _attach(name, shape, dtype, model, window):
+    # Workers share the resource tracker of the parent, which unlinks
+    shm = shared_memory.SharedMemory(name=name)
+    _worker['shm'] = shm
+    _worker['cube'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker['model'] = model
+    _worker['window'] = window
+
+
+def _fit_task(task):
+    i, seed = task
+    p, rms, it, ok = fit_frame(_worker['cube'][i], _worker['model'], seed,
+                               _worker['window'])
+    return i, p, rms, it, ok
+
+
+def fit_cube(cube, wavelengths=None, model='gaussian', window=16,
+             max_workers=None):
+    '''
+    Fits every frame of a cube in a process pool.
+
+    @param cube: ndarray (n_frames, height, width)
+    @param wavelengths: Wavelength of each frame (nm), indices when None
+    @param model: 'gaussian' or 'airy'
+    @param window: Half width of the fitted window
+    @param max_workers: Number of processes, os.cpu_count() when None
+    @return: Structured ndarray, one row per frame with the wavelength,
+             model parameters, residual rms, iterations and convergence
+    '''
+    if model not in MODELS:
+        raise Exception('Unknown PSF model %s' % str(model))
+    cube = np.ascontiguousarray(cube)
+    n = cube.shape[0]
+    if wavelengths is None:
+        wavelengths = np.arange(n, dtype=np.float64)
+
+    # Seed each frame with the moments of the previous wavelength
+    moments = [moment_seed(frame, model, window) for frame in cube]
+    seeds = [moments[max(i - 1, 0)] for i in range(n)]
+
+    names = PARAMS[model]
+    dtype = [('wavelength_nm', np.float64)] + \
+        [(k, np.float64) for k in names] + \
+        [('rms', np.float64), ('iterations', np.int32), ('converged', bool)]
+    table = np.zeros(n, dtype=dtype)
+    table['wavelength_nm'] = wavelengths
+
+    shm = shared_memory.SharedMemory(create=True, size=max(cube.nbytes, 1))
+    try:
+        shared = np.ndarray(cube.shape, dtype=cube.dtype, buffer=shm.buf)
+        shared[:] = cube
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_attach,
+                initargs=(shm.name, cube.shape, cube.dtype.str, model,
+                          window)) as pool:
+            chunksize = max(1, n // (4 * (max_workers or os.cpu_count() or 1)))
+            for i, p, rms, it, ok in pool.map(_fit_task, enumerate(seeds),
+                                              chunksize=chunksize):
+                for k, value in zip(names, p):
+                    table[k][i] = value
+                table['rms'][i] = rms
+                table['iterations'][i] = it
+                table['converged'][i] = ok
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return table
+
+
+def load_capture_folder(folder):
+    '''
+    Loads the CSV frames of a captures folder into a cube. A cube written
+    by laserscan.convert is memory mapped instead.
+    @return: (cube, wavelengths)
+    '''
+    if os.path.exists(os.path.join(folder, convert.INDEX_NAME)):
+        cube, wavelengths, _ = convert.load_cube(folder)
+        return cube, wavelengths
+    captures = list_captures(folder)
+    if not captures:
+        raise Exception('No capture files found in %s' % str(folder))
+    frames = [np.loadtxt(path, delimiter=',', skiprows=1, dtype=np.float32)
+              for _, _, path in captures]
+    return np.stack(frames), np.array([c[0] for c in captures])
+
+
+def fit_folder(folder, model='gaussian', **kwargs):
+    '''
+    Fits all frames of a captures folder, see fit_cube().
+    '''
+    cube, wavelengths = load_capture_folder(folder)
+    return fit_cube(cube, wavelengths, model, **kwargs)
+
+
+def save_fit_table(table, filepath):
+    '''
+    Writes a fit table as CSV.
+    '''
+    np.savetxt(filepath, table, delimiter=',',
+               header=','.join(table.dtype.names), comments='',
+               fmt=['%.6g'] * (len(table.dtype.names) - 2) + ['%d', '%d'])
@@ -0,0 +1,272 @@
+'''
+Compressed frame store.
+
+16 bit frames compress well after a horizontal delta, which turns the
+smooth image into small (zigzag coded) residuals, and a byte shuffle,
+which groups the mostly zero high bytes together. Chunks of frames are
+transformed with numpy and compressed with zlib or lzma on a thread
+pool; both release the GIL, so compression scales with the number of
+cores. Which transform wins depends on the noise level, compare them
+with benchmarks/bench_compression.py. Compressed
+chunks are appended in order to one data file, and a JSON index of chunk
+offsets gives random access to any frame, e.g. any wavelength.
+
+Example:
+    store = FrameStore(os.path.join(output_dir, 'frames'), dims, np.uint16)
+    store.write_frame(frame, key=1530.0)
+    ...
+    store.close()
+    print(store.stats())
+    frame = FrameReader(os.path.join(output_dir, 'frames')).read_key(1530.0)
+'''
+
+import collections
+import concurrent.futures
+import json
+import lzma
+import os
+import time
+import zlib
+import numpy as np
+
+DATA_SUFFIX = '.xfs'
+INDEX_SUFFIX = '.xfs.json'
+
+CODECS = ('zlib', 'lzma', 'none')
+TRANSFORMS = ('delta+shuffle', 'delta', 'shuffle', 'none')
+
+
+def encode(frames, transform):
+    '''
+    Applies the predictive transform to a stack of frames.
+    @param frames: ndarray (n, height, width) of a 16 bit dtype
+    @return: bytes-like
+    '''
+    data = frames.view(np.uint16) if frames.dtype.itemsize == 2 else frames
+    if 'delta' in transform:
+        delta = np.empty_like(data)
+        delta[..., 0] = data[..., 0]
+        # Unsigned arithmetic wraps, so the delta is lossless
+        np.subtract(data[..., 1:], data[..., :-1], out=delta[..., 1:])
+        if data.dtype == np.uint16:
+            # Zigzag, small negative residuals get small codes (zero high
+            # byte) instead of 0xffxx
+            signed = delta.view(np.int16)
+            delta = ((signed << 1) ^ (signed >> 15)).view(np.uint16)
+        data = delta
+    if 'shuffle' in transform:
+        b = data.view(np.uint8).reshape(-1, data.dtype.itemsize)
+        return np.ascontiguousarray(b.T).data
+    return np.ascontiguousarray(data).data
+
+
+def decode(buffer, shape, dtype, transform):
+    '''
+    Inverts encode().
+    @return: ndarray of shape and dtype
+    '''
+    dtype = np.dtype(dtype)
+    work = np.uint16 if dtype.itemsize == 2 else dtype
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    if 'shuffle' in transform:
+        raw = np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T)
+    data = raw.view(work).reshape(shape)
+    if 'delta' in transform:
+        if work == np.uint16:
+            # Undo the zigzag
+            data = (data >> 1) ^ (-(data & 1).view(np.int16)).view(np.uint16)
+        data = np.cumsum(data, axis=-1, dtype=work)
+    return data.view(dtype)
+
+
+def _compress(frames, transform, codec, level):
+    data = encode(frames, transform)
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    return bytes(data)
+
+
+def _decompress(blob, codec):
+    if codec == 'zlib':
+        return zlib.decompress(blob)
+    if codec == 'lzma':
+        return lzma.decompress(blob)
+    return blob
+
+
+class FrameStore(object):
+    '''
+    Writes frames as compressed chunks. Can be used as a handler for
+    XevaCam.set_handler().
+    '''
+
+    def __init__(self, path, dims, dtype, codec='zlib', level=1,
+                 transform='delta+shuffle', frames_per_chunk=1,
+                 max_workers=None, max_pending=None):
+        '''
+        @param path: Base path, '.xfs' and '.xfs.json' are appended
+        @param dims: Frame dimensions (height, width)
+        @param dtype: Frame dtype, transforms expect 16 bit pixels
+        @param codec: 'zlib', 'lzma' or 'none'
+        @param level: zlib level or lzma preset
+        @param transform: One of TRANSFORMS
+        @param frames_per_chunk: Frames compressed together
+        @param max_workers: Compression threads, os.cpu_count() when None
+        @param max_pending: Chunks in flight before write blocks, twice
+                            the number of threads when None
+        '''
+        if codec not in CODECS:
+            raise Exception('Unknown codec %s' % str(codec))
+        if transform not in TRANSFORMS:
+            raise Exception('Unknown transform %s' % str(transform))
+        self.path = path
+        self.dims = tuple(int(d) for d in dims)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.level = level
+        self.transform = transform
+        self.frames_per_chunk = frames_per_chunk
+        workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * workers
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='framestore')
+        self._pending = collections.deque()  # (future, keys, n_frames)
+        self._chunk = np.empty((frames_per_chunk,) + self.dims, dtype=self.dtype)
+        self._chunk_keys = []
+        self._file = open(path + DATA_SUFFIX, 'wb')
+        self._offset = 0
+        self.chunks = []  # [offset, length, first frame, n frames]
+        self.keys = []  # Key of each frame, e.g. wavelength
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self._start = None
+        self._elapsed = 0.0
+
+    def write(self, b):
+        '''
+        Handler interface: writes a raw frame buffer.
+        '''
+        frame = np.frombuffer(b, dtype=self.dtype).reshape(self.dims)
+        self.write_frame(frame)
+        return len(b)
+
+    def write_frame(self, frame, key=None):
+        '''
+        Adds a frame. The frame is copied, so the caller can reuse it.
+        @param frame: ndarray of the store dtype, or one that casts to it
+                      within the same kind (e.g. uint8 into uint16).
+                      Corrected float frames are rejected, they would be
+                      truncated and wrap around.
+        @param key: Optional key for read_key(), e.g. the wavelength
+        '''
+        if not np.can_cast(frame.dtype, self.dtype, 'same_kind'):
+            raise Exception('Can\'t store %s frames in a %s store' % (
+                frame.dtype, self.dtype))
+        if self._start is None:
+            self._start = time.perf_counter()
+        n = len(self._chunk_keys)
+        self._chunk[n] = frame
+        self._chunk_keys.append(key if key is not None else len(self.keys) + n)
+        if n + 1 == self.frames_per_chunk:
+            self._submit()
+
+    def _submit(self):
+        n = len(self._chunk_keys)
+        if n == 0:
+            return
+        frames = self._chunk[:n].copy()
+        future = self._pool.submit(_compress, frames, self.transform,
+                                   self.codec, self.level)
+        self._pending.append((future, self._chunk_keys, n))
+        self._chunk_keys = []
+        self.raw_bytes += frames.nbytes
+        # Write finished chunks in order, block only when too many wait
+        while self._pending and (self._pending[0][0].done() or
+                                 len(self._pending) > self.max_pending):
+            self._write_next()
+
+    def _write_next(self):
+        future, keys, n = self._pending.popleft()
+        blob = future.result()
+        self._file.write(blob)
+        self.chunks.append([self._offset, len(blob), len(self.keys), n])
+        self.keys.extend(keys)
+        self._offset += len(blob)
+        self.compressed_bytes += len(blob)
+
+    def flush(self):
+        '''
+        Compresses the partial chunk and writes everything pending.
+        '''
+        self._submit()
+        while self._pending:
+            self._write_next()
+        self._file.flush()
+        if self._start is not None:
+            self._elapsed = time.perf_counter() - self._start
+
+    def close(self):
+        self.flush()
+        self._pool.shutdown()
+        self._file.close()
+        index = {'dims': list(self.dims),
+                 'dtype': self.dtype.str,
+                 'codec': self.codec,
+                 'transform': self.transform,
+                 'chunks': self.chunks,
+                 'keys': self.keys,
+                 'stats': self.stats()}
+        with open(self.path + INDEX_SUFFIX, 'w') as f:
+            json.dump(index, f)
+
+    def stats(self):
+        '''
+        @return: dict with raw and compressed bytes, the compression ratio
+                 and the throughput in raw MB/s
+        '''
+        ratio = self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+        rate = self.raw_bytes / self._elapsed / 1e6 if self._elapsed else 0.0
+        return {'raw_bytes': self.raw_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'ratio': ratio,
+                'MB_per_s': rate}
+
+
+class FrameReader(object):
+    '''
+    Random access to a FrameStore.
+    '''
+
+    def __init__(self, path):
+        with open(path + INDEX_SUFFIX) as f:
+            self.index = json.load(f)
+        self.path = path
+        self.dims = tuple(self.index['dims'])
+        self.dtype = np.dtype(self.index['dtype'])
+        self.keys = self.index['keys']
+        self._chunk_starts = np.array([c[2] for c in self.index['chunks']])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def read(self, i):
+        '''
+        @param i: Frame number
+        @return: ndarray
+        '''
+        c = int(np.searchsorted(self._chunk_starts, i, side='right')) - 1
+        offset, length, first, n = self.index['chunks'][c]
+        with open(self.path + DATA_SUFFIX, 'rb') as f:
+            f.seek(offset)
+            blob = f.read(length)
+        frames = decode(_decompress(blob, self.index['codec']),
+                        (n,) + self.dims, self.dtype, self.index['transform'])
+        return frames[i - first]
+
+    def read_key(self, key):
+        '''
+        @param key: Key given to write_frame(), e.g. the wavelength
+        '''
+        return self.read(self.keys.index(key))
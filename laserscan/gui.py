@@ -3,6 +3,9 @@ import customtkinter
 import time
 import os
 from laserscan.aux_funcs import *
+from laserscan.psf import PSFTable
+from laserscan.laserio import LaserIO
+from laserscan.wavecal import log_label
 from datetime import datetime
 
 default = {
@@ -15,15 +18,28 @@ default = {
     'lowgain' : 1
 }
 
+LASER_TIMEOUT = 10  # Seconds to wait for queued laser commands
+
 
 class LaserScanApp:
     ''' GUI setup '''
-    def __init__(self, laser, cam, output_dir):
+    def __init__(self, laser, cam, output_dir, corrector=None, background=None,
+                 group=None, calibration=None):
         self.laser = laser
         self.cam = cam
+        self.corrector = corrector  # Optional correction.FrameCorrector
+        self.background = background  # Optional background.InterleavedBackground
+        self.group = group  # Optional xevacam.group.CameraGroup, cam first
+        self.calibration = calibration  # Optional wavecal.WavelengthCalibration
+        # Every scan command goes through the laser I/O worker, so the
+        # wavelength read-back overlaps the capture and stays in order
+        self.laser_io = LaserIO(laser)
+        self.calibrated_scan = False  # Labels from the table, no read-back
+        self.command_shift = 0.0  # Commanded minus entered wavelength
         self.csv_files = []
         self.should_quit = False
         self.output_dir = output_dir
+        self.psf_table = PSFTable(os.path.join(output_dir, "psf_metrics.csv"))
 
         self.current_wl = None
         self.start_wl = None
@@ -94,7 +110,7 @@ class LaserScanApp:
 
     def SET(self):
         try:
-            self.laser.power_level = float(self.laser_pow.get())
+            self.laser_io.set('power_level', float(self.laser_pow.get()))
         except ValueError:
             self.SysMSGs.configure(text="Laser power not a number")
             return
@@ -127,34 +143,77 @@ class LaserScanApp:
             lowgain_val = int(self.lowgain_entry.get())
             if lowgain_val not in (0, 1):
                 raise ValueError("LowGain must be 0 or 1")
-            self.cam.set_property(lowgain_val, name="LowGain", propType="bool")
+            # One pipeline flush for both settings
+            self.cam.set_properties([("LowGain", lowgain_val, "bool"),
+                                     ("IntegrationTime", self.integration_time, "num")])
         except Exception as e:
             self.SysMSGs.configure(text=f"LowGain setting failed: {e}")
             return
 
+        if self.corrector is not None:
+            try:
+                self.laser_sync()
+                self.corrector.prepare(self.cam, self.laser,
+                                       self.integration_time, lowgain_val)
+            except Exception as e:
+                self.SysMSGs.configure(text=f"Dark frame capture failed: {e}")
+                return
+
+        try:
+            # Record the full camera state of the scan
+            self.cam.save_properties(os.path.join(
+                self.output_dir,
+                f"camera_state_{datetime.now().strftime('%H-%M-%S')}.json"))
+        except Exception as e:
+            print(f"Saving camera state failed: {e}")
+
         self.current_wl = self.start_wl
 
+        start_cmd, stop_cmd = self.start_wl, self.stop_wl
+        if self.calibration is not None:
+            # Pre-compensated, the laser emits the entered wavelengths. The
+            # table must cover the range the laser is driven over, beyond
+            # its ends np.interp only repeats the end offset.
+            comp_start = round(float(self.calibration.command_for(self.start_wl)), 3)
+            comp_stop = round(float(self.calibration.command_for(self.stop_wl)), 3)
+            self.calibrated_scan = self.calibration.covers(
+                comp_start, comp_stop, max(abs(self.step_size), 1.0))
+            if self.calibrated_scan:
+                start_cmd, stop_cmd = comp_start, comp_stop
+        self.command_shift = start_cmd - self.start_wl
+
         try:
-            self.laser.start_wavelength = self.start_wl
-            self.laser.stop_wavelength = self.stop_wl
-            self.laser.step_size = self.step_size
-            self.laser.power = True
-            self.laser.write("OUTP:SCAN:STAR -4")
+            self.laser_io.set('start_wavelength', start_cmd)
+            self.laser_io.set('stop_wavelength', stop_cmd)
+            self.laser_io.set('step_size', self.step_size)
+            self.laser_io.set('power', True)
+            self.laser_io.write("OUTP:SCAN:STAR -4")
+            self.laser_sync()
         except Exception as e:
             self.SysMSGs.configure(text=f"Failed to restart scan: {e}")
             return
 
+        if self.background is not None:
+            self.background.capture_background(self.cam, self.laser)
+
         self.disp_w.delete(0, 'end')
         self.disp_w.insert(0, f"{self.current_wl:.2f} nm")
         self.SysMSGs.configure(text="New scan parameters loaded")
-        
+
+        reading = self.start_wavelength_reading()
         csv_path = capture_and_save_image(
         self.cam,
         wavelength_nm=self.current_wl,
         integration_time_us=self.integration_time,
-        output_dir=self.output_dir
+        output_dir=self.output_dir,
+        corrector=self.corrector,
+        psf_table=self.psf_table,
+        background=self.background,
+        group=self.group
         )
         self.csv_files.append(csv_path)
+        self.label_wavelength(csv_path, reading)
+        self.show_psf_metrics()
         
         img_path = csv_path.replace('.csv', '.png')
         img = Image.open(img_path)
@@ -165,6 +224,55 @@ class LaserScanApp:
 
 
 
+    def laser_sync(self):
+        '''
+        Waits for the queued laser commands, including a read-back that
+        timed out, and raises their errors. Called before capturing and
+        before anything that uses the laser directly (dark frames,
+        backgrounds).
+        '''
+        self.laser_io.flush(LASER_TIMEOUT)
+
+    def start_wavelength_reading(self):
+        '''
+        Queries the laser wavelength in the background, so the read-back
+        overlaps the capture. None when the calibration table already
+        covers the scan, or without a calibration.
+        '''
+        if self.calibration is None or self.calibrated_scan:
+            return None
+        return self.laser_io.get('wavelength')
+
+    def label_wavelength(self, csv_path, reading):
+        '''
+        Records the measured wavelength of a frame, read back or from
+        the calibration table, in wavelength_labels.csv.
+        '''
+        if self.calibration is None:
+            return
+        name = os.path.splitext(os.path.basename(csv_path))[0]
+        # The laser steps from the pre-compensated start
+        commanded = self.current_wl + self.command_shift
+        if reading is not None:
+            try:
+                measured = reading.result(timeout=LASER_TIMEOUT)
+            except Exception as e:
+                print(f"Wavelength read-back failed: {e}")
+                return
+            self.calibration.record(commanded, measured)
+            source = 'readback'
+        else:
+            measured = float(self.calibration.measured(commanded))
+            source = 'table'
+        log_label(self.output_dir, name, commanded, measured, source)
+
+    def show_psf_metrics(self):
+        m = self.psf_table.rows[-1]
+        self.SysMSGs.configure(
+            text=f"{m['wavelength_nm']:.2f} nm: centroid ({m['centroid_col']:.2f}, "
+                 f"{m['centroid_row']:.2f}) px, FWHM {m['fwhm_col']:.2f} x "
+                 f"{m['fwhm_row']:.2f} px, peak {m['peak']:.0f}")
+
     def NEXT(self):
         if self.should_quit:
             return
@@ -173,25 +281,51 @@ class LaserScanApp:
             self.SysMSGs.configure(text="Please press SET first.")
             return
 
-        self.laser.write(":OUTP:SCAN:STEP\n")
-        time.sleep(0.5)
+        def step():
+            # Waits, the step must be done while the output is off
+            self.laser_io.submit(self.laser.write,
+                                 ":OUTP:SCAN:STEP\n").result(LASER_TIMEOUT)
+
+        try:
+            self.laser_sync()
+            if self.background is not None and self.background.due():
+                # Step while the output is off, the settle times overlap
+                self.background.capture_background(self.cam, self.laser, step=step)
+            else:
+                step()
+                time.sleep(0.5)
+            self.laser_sync()
+        except Exception as e:
+            self.SysMSGs.configure(text=f"Laser step failed: {e}")
+            return
 
         self.current_wl += self.step_size
 
         if self.current_wl > self.stop_wl:
+            if self.background is not None:
+                self.background.finish(self.cam, self.laser)
+            if self.calibration is not None:
+                self.calibration.save()
             self.SysMSGs.configure(text="Reached stop wavelength.")
             return
 
         self.disp_w.delete(0, 'end')
         self.disp_w.insert(0, f"{self.current_wl:.2f} nm")
 
+        reading = self.start_wavelength_reading()
         csv_path = capture_and_save_image(
             self.cam,
             wavelength_nm=self.current_wl,
             integration_time_us=self.integration_time,
-            output_dir=self.output_dir
+            output_dir=self.output_dir,
+            corrector=self.corrector,
+            psf_table=self.psf_table,
+            background=self.background,
+            group=self.group
         )
         self.csv_files.append(csv_path)
+        self.label_wavelength(csv_path, reading)
+        self.show_psf_metrics()
 
         png_path = csv_path.replace('.csv', '.png')
         img = Image.open(png_path)
@@ -204,8 +338,17 @@ class LaserScanApp:
     def QUIT(self):
         self.should_quit = True
         try:
+            self.laser_sync()
+        except Exception as e:
+            print(f"Laser command failed: {e}")
+        try:
+            if self.background is not None:
+                self.background.finish(self.cam, self.laser)
+            if self.calibration is not None:
+                self.calibration.save()
             self.cam.close()
-            self.laser.write(":OUTP:SCAN:ABOR")
+            self.laser_io.write(":OUTP:SCAN:ABOR")
+            self.laser_io.close()
         except Exception as e:
             print(f"Error while closing: {e}")
         self.root.destroy()
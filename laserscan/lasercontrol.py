@@ -1,3 +1,6 @@
+import threading
+import time
+from pymeasure.adapters import Adapter
 from pymeasure.instruments import Instrument
 
 class LaserSource(Instrument):
@@ -6,7 +9,34 @@ class LaserSource(Instrument):
     such as power, wavelength range, scanning step size, etc.
     '''
     def __init__(self, adapter, name="Laser Source", **kwargs):
+        # One command or query/reply pair on the bus at a time, whichever
+        # thread calls (GUI, laserio.LaserIO worker, metrics)
+        self._io_lock = threading.RLock()
         super().__init__(adapter, name, **kwargs)
+        # Counters for monitoring, see laserscan.metrics
+        self.commands_count = 0
+        self.queries_count = 0
+        self.query_time = 0.0  # Total seconds spent in queries
+        self.last_query_latency = 0.0
+        self.last_wavelength = None  # Last wavelength set or read (nm)
+
+    def write(self, command, **kwargs):
+        '''Sends a command, counting it for monitoring'''
+        with self._io_lock:
+            self.commands_count += 1
+            super().write(command, **kwargs)
+
+    def ask(self, command, *args, **kwargs):
+        '''Queries the laser, measuring the round trip latency'''
+        with self._io_lock:
+            start = time.perf_counter()
+            try:
+                return super().ask(command, *args, **kwargs)
+            finally:
+                latency = time.perf_counter() - start
+                self.queries_count += 1
+                self.query_time += latency
+                self.last_query_latency = latency
 
     @property
     def power(self):
@@ -33,7 +63,9 @@ class LaserSource(Instrument):
     @property
     def wavelength(self):
         '''Current wavelength reading'''
-        return float(self.ask(":WAVelength?").strip())
+        value = float(self.ask(":WAVelength?").strip())
+        self.last_wavelength = value
+        return value
 
     @wavelength.setter
     def wavelength(self, value):
@@ -41,6 +73,7 @@ class LaserSource(Instrument):
         if not (1500 <= value <= 1570):
             raise ValueError("Wavelength must be between 1500 and 1570 nm.")
         self.write(f":WAVelength {value:.2f}")
+        self.last_wavelength = value
 
     dwell_time = Instrument.control(
         "WAVE:DWEL?", "WAVE:DWEL %0.3f", "set and query the dwell time (ms)"
@@ -51,5 +84,49 @@ class LaserSource(Instrument):
     )
 
 
+class SimulatedLaserAdapter(Adapter):
+    '''
+    Stands in for the GPIB adapter, for testing without the laser:
+
+        laser = LaserSource(SimulatedLaserAdapter(latency=0.02))
+
+    Keeps the laser settings in a dict, answers queries from it and
+    simulates the round trip time of the bus. Sent commands are kept
+    in self.commands.
+    '''
+    def __init__(self, latency=0.01, wavelength=1550.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency  # Seconds per write or read
+        self.state = {'OUTP': '0', 'WAVE': wavelength, 'SOUR:POW:LEV': 0.0,
+                      'WAVE:STAR': 1530.0, 'WAVE:STOP': 1560.0,
+                      'WAVE:DWEL': 2000.0, 'WAVE:STEP': 1.0}
+        self.commands = []
+        self._reply = ''
+
+    @staticmethod
+    def _key(command):
+        key = command.strip().lstrip(':').upper()
+        return key.replace('OUTPUT', 'OUTP').replace('WAVELENGTH', 'WAVE')
+
+    def _write(self, command, **kwargs):
+        time.sleep(self.latency)
+        self.commands.append(command)
+        key = self._key(command)
+        if key.endswith('?'):
+            self._reply = str(self.state.get(key[:-1], '0'))
+        elif key == 'OUTP:SCAN:STEP':
+            self.state['WAVE'] = float(self.state['WAVE']) + float(self.state['WAVE:STEP'])
+        elif key == 'OUTP:SCAN:STAR -4':
+            self.state['WAVE'] = float(self.state['WAVE:STAR'])
+        elif ' ' in key:
+            key, value = key.split(' ', 1)
+            self.state[key] = value
+
+    def _read(self, **kwargs):
+        time.sleep(self.latency)
+        reply, self._reply = self._reply, ''
+        return reply
+
+
 if __name__ == "__main__":
     print('test lasercontrol:')
\ No newline at end of file
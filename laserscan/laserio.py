@@ -0,0 +1,184 @@
+'''
+Pipelined laser I/O.
+
+Every LaserSource access is a GPIB round trip that blocks the caller.
+LaserIO runs all accesses on one I/O worker thread, which also keeps
+them in order on the adapter, and hands out futures instead:
+
+    io = LaserIO(laser)
+    io.set('wavelength', 1550.0)       # Fire and forget
+    reading = io.get('wavelength')     # Query issued now
+    frame = cam.capture_frame_only()   # Runs while the laser answers
+    measured = reading.result()
+    io.check_errors()                  # Raises a failed write
+    io.close()
+
+Writes that need no reply return at once; their errors are collected and
+raised by check_errors() or flush(). Queries can be issued ahead of need
+with prefetch() and picked up later with value(). For asyncio code,
+aget()/aset() await the same worker.
+
+LaserSource serializes its writes and query/reply pairs with a lock, so
+direct calls from other threads are safe on the bus, but they are not
+ordered with the requests queued here; call flush() first when the
+order matters. laserscan.lasercontrol.SimulatedLaserAdapter gives a
+laser without hardware for testing.
+'''
+
+import asyncio
+import concurrent.futures
+import threading
+
+
+class LaserIO(object):
+
+    def __init__(self, laser, max_errors=100):
+        '''
+        @param laser: LaserSource
+        @param max_errors: Failed writes kept for check_errors()
+        '''
+        self.laser = laser
+        self.max_errors = max_errors
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='laser_io')
+        self._errors = []
+        self._errors_lock = threading.Lock()
+        self._prefetched = {}
+        self._pending_lock = threading.Lock()
+        self.pending = 0  # Requests not finished yet
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Runs func(*args, **kwargs) on the I/O worker.
+        @return: concurrent.futures.Future
+        '''
+        with self._pending_lock:
+            self.pending += 1
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._pending_lock:
+            self.pending -= 1
+
+    def _forget(self, future):
+        # Collects the error of a fire and forget request
+        error = future.exception()
+        if error is not None:
+            print('LaserIO', 'Write failed: %s' % str(error))
+            with self._errors_lock:
+                if len(self._errors) < self.max_errors:
+                    self._errors.append(error)
+
+    def write(self, command):
+        '''
+        Sends a command without waiting.
+        @return: Future, errors are also collected for check_errors()
+        '''
+        future = self.submit(self.laser.write, command)
+        future.add_done_callback(self._forget)
+        return future
+
+    def ask(self, command):
+        '''
+        @return: Future of the reply string
+        '''
+        return self.submit(self.laser.ask, command)
+
+    def set(self, name, value):
+        '''
+        Sets a LaserSource property without waiting, e.g.
+        io.set('power', True).
+        '''
+        self._prefetched.pop(name, None)  # Stale after the change
+        future = self.submit(setattr, self.laser, name, value)
+        future.add_done_callback(self._forget)
+        return future
+
+    def get(self, name):
+        '''
+        Reads a LaserSource property, e.g. io.get('wavelength').
+        @return: Future of the value
+        '''
+        return self.submit(getattr, self.laser, name)
+
+    def prefetch(self, name):
+        '''
+        Issues a property query ahead of need, see value().
+        '''
+        future = self.get(name)
+        self._prefetched[name] = future
+        return future
+
+    def value(self, name, timeout=None):
+        '''
+        @return: The prefetched value of a property, read now if it was
+                 not prefetched
+        '''
+        future = self._prefetched.pop(name, None) or self.get(name)
+        return future.result(timeout)
+
+    def flush(self, timeout=None):
+        '''
+        Waits until every request issued so far is done, then raises
+        collected write errors.
+        '''
+        self.submit(lambda: None).result(timeout)
+        self.check_errors()
+
+    def check_errors(self):
+        '''
+        Raises the first failed fire and forget request, if any, and
+        clears the list.
+        '''
+        with self._errors_lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise Exception('%d laser command(s) failed, first: %s' % (
+                len(errors), str(errors[0])))
+
+    async def aget(self, name):
+        return await asyncio.wrap_future(self.get(name))
+
+    async def aset(self, name, value):
+        '''
+        Sets a property and waits for it, raising its error.
+        '''
+        self._prefetched.pop(name, None)
+        return await asyncio.wrap_future(
+            self.submit(setattr, self.laser, name, value))
+
+    async def aask(self, command):
+        return await asyncio.wrap_future(self.ask(command))
+
+    def close(self):
+        '''
+        Finishes the queued requests and stops the worker.
+        '''
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    # Overlap of laser queries and a simulated 50 ms exposure
+    import time
+    from laserscan.lasercontrol import LaserSource, SimulatedLaserAdapter
+
+    laser = LaserSource(SimulatedLaserAdapter(latency=0.02), includeSCPI=False)
+    start = time.perf_counter()
+    for _ in range(5):
+        laser.write(":OUTP:SCAN:STEP")
+        laser.wavelength
+        time.sleep(0.05)
+    print('blocking: %.2f s' % (time.perf_counter() - start))
+
+    io = LaserIO(laser)
+    start = time.perf_counter()
+    for _ in range(5):
+        io.write(":OUTP:SCAN:STEP")
+        reading = io.get('wavelength')
+        time.sleep(0.05)
+        reading.result()
+    io.flush()
+    print('pipelined: %.2f s' % (time.perf_counter() - start))
+    io.close()
@@ -0,0 +1,270 @@
+'''
+Metrics for monitoring long unattended scan sessions.
+
+Collectors read counters that the camera, the laser and the streams keep
+anyway. They only read attributes and never take locks held by the
+acquisition thread, so polling can not stall capturing. The exporter
+renders the Prometheus text exposition format to a file periodically and
+optionally serves it on a localhost HTTP endpoint.
+
+Example:
+    exporter = MetricsExporter(os.path.join(output_dir, 'metrics.prom'))
+    exporter.add_collector(camera_collector(cam))
+    exporter.add_collector(laser_collector(laser))
+    exporter.add_collector(stream_collector(stream, 'envi'))
+    exporter.start()
+    ...
+    exporter.stop()
+'''
+
+import http.server
+import os
+import threading
+import time
+
+from laserscan.xevacam.xevadll import XDLL
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+
+class Sample(object):
+    '''
+    A single metric value.
+    '''
+
+    __slots__ = ('name', 'kind', 'help', 'value', 'labels')
+
+    def __init__(self, name, kind, help, value, labels=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.value = value
+        self.labels = labels or {}
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render(samples, prefix='laserscan_'):
+    '''
+    Formats samples in the Prometheus text exposition format.
+
+    @param samples: Iterable of Sample
+    @param prefix: Prepended to every metric name
+    @return: str
+    '''
+    families = {}
+    for s in samples:
+        families.setdefault(s.name, []).append(s)
+    lines = []
+    for name, family in families.items():
+        full_name = prefix + name
+        lines.append('# HELP %s %s' % (full_name, family[0].help))
+        lines.append('# TYPE %s %s' % (full_name, family[0].kind))
+        for s in family:
+            if s.value is None:
+                continue
+            labels = ''
+            if s.labels:
+                labels = '{%s}' % ','.join(
+                    '%s="%s"' % (k, _escape(v)) for k, v in sorted(s.labels.items()))
+            lines.append('%s%s %r' % (full_name, labels, float(s.value)))
+    return '\n'.join(lines) + '\n'
+
+
+def camera_collector(cam, camera='0'):
+    '''
+    Collector for XevaCam: frames, dropped frames, errors by XDLL.errcodes
+    name, the queue depth of its handlers and their delivery lag and drops.
+
+    @param cam: XevaCam
+    @param camera: Value of the 'camera' label
+    '''
+    def collect():
+        labels = {'camera': camera}
+        stats = cam.stats
+        yield Sample('camera_frames_total', COUNTER,
+                     'Frames captured in the current recording',
+                     stats.frames, labels)
+        yield Sample('camera_dropped_frames_total', COUNTER,
+                     'Frames missed in the current recording',
+                     stats.dropped, labels)
+        yield Sample('camera_frame_interval_seconds', GAUGE,
+                     'Average frame interval', stats.interval_avg * 1e-9, labels)
+        yield Sample('camera_capture_cpu_seconds_total', COUNTER,
+                     'CPU time of the capture thread', stats.cpu_time * 1e-9,
+                     labels)
+        yield Sample('camera_recording', GAUGE,
+                     'Capture thread is alive', int(cam.is_alive()), labels)
+        errors = dict(cam.error_counts)  # Atomic copy
+        for code in (XDLL.errcodes[c] for c in sorted(XDLL.errcodes)):
+            if code in errors:
+                yield Sample('camera_errors_total', COUNTER,
+                             'DLL errors by error code',
+                             errors[code], dict(labels, code=code))
+        depth = 0
+        for handler, _ in list(cam.handlers):
+            backlog = getattr(handler, 'backlog', None)
+            if backlog is not None:
+                depth += backlog()
+        yield Sample('camera_queue_depth', GAUGE,
+                     'Frames queued in the handlers', depth, labels)
+        for i, h in enumerate(cam.get_handler_stats()):
+            h_labels = dict(labels, handler='%d_%s' % (i, h['handler']))
+            yield Sample('camera_handler_lag_frames', GAUGE,
+                         'Frames waiting in the delivery queue of a handler',
+                         h['lag'], h_labels)
+            yield Sample('camera_handler_dropped_frames_total', COUNTER,
+                         'Frames dropped by the delivery policy of a handler',
+                         h['dropped'], h_labels)
+            yield Sample('camera_handler_latency_max_seconds', GAUGE,
+                         'Longest time from capture to handler write',
+                         h['latency_max'], h_labels)
+    return collect
+
+
+def laser_collector(laser):
+    '''
+    Collector for LaserSource. Reports cached values only, it never talks
+    to the instrument.
+
+    @param laser: LaserSource
+    '''
+    def collect():
+        yield Sample('laser_commands_total', COUNTER,
+                     'Commands sent to the laser', laser.commands_count)
+        yield Sample('laser_queries_total', COUNTER,
+                     'Queries answered by the laser', laser.queries_count)
+        yield Sample('laser_query_seconds_total', COUNTER,
+                     'Time spent in laser queries', laser.query_time)
+        yield Sample('laser_query_latency_seconds', GAUGE,
+                     'Latency of the latest laser query',
+                     laser.last_query_latency)
+        yield Sample('laser_wavelength_nm', GAUGE,
+                     'Latest wavelength set or read', laser.last_wavelength)
+    return collect
+
+
+def stream_collector(stream, writer):
+    '''
+    Collector for a writer stream, e.g. XevaStream.
+
+    @param stream: Object with bytes_written attribute and backlog() method
+    @param writer: Value of the 'writer' label
+    '''
+    def collect():
+        labels = {'writer': writer}
+        yield Sample('writer_bytes_total', COUNTER,
+                     'Bytes written to the stream', stream.bytes_written, labels)
+        yield Sample('writer_backlog', GAUGE,
+                     'Buffers waiting in the stream', stream.backlog(), labels)
+    return collect
+
+
+class MetricsExporter(object):
+    '''
+    Polls collectors in a background thread and exports the metrics.
+    '''
+
+    def __init__(self, filepath=None, interval=10.0, http_port=None):
+        '''
+        @param filepath: Path of the exposition file, None disables it
+        @param interval: Polling interval in seconds
+        @param http_port: Serve metrics on http://127.0.0.1:<port>/metrics,
+                          None disables the endpoint
+        '''
+        self.filepath = filepath
+        self.interval = interval
+        self.http_port = http_port
+        self.collectors = []
+        self._text = ''
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def add_collector(self, collector):
+        '''
+        @param collector: Callable returning an iterable of Sample
+        '''
+        self.collectors.append(collector)
+
+    def collect(self):
+        '''
+        Polls all collectors once.
+        @return: Exposition text
+        '''
+        samples = [Sample('exporter_timestamp_seconds', GAUGE,
+                          'Time of the latest poll', time.time())]
+        for collector in self.collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                # A failing collector must not stop monitoring
+                print('MetricsExporter', 'Collector failed: %s' % str(e))
+        self._text = render(samples)
+        return self._text
+
+    def write(self):
+        '''
+        Writes the exposition file atomically.
+        '''
+        tmp = self.filepath + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self._text)
+        os.replace(tmp, self.filepath)
+
+    def start(self):
+        self._stop.clear()
+        if self.http_port is not None:
+            self._server = http.server.ThreadingHTTPServer(
+                ('127.0.0.1', self.http_port), self._handler_class())
+            threading.Thread(name='metrics http thread',
+                             target=self._server.serve_forever,
+                             daemon=True).start()
+        self._thread = threading.Thread(name='metrics thread',
+                                        target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 1)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _run(self):
+        while True:
+            self.collect()
+            if self.filepath:
+                try:
+                    self.write()
+                except OSError as e:
+                    print('MetricsExporter', 'Writing failed: %s' % str(e))
+            if self._stop.wait(self.interval):
+                break
+
+    def _handler_class(self):
+        exporter = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter._text.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep the console for scan messages
+
+        return MetricsHandler
@@ -0,0 +1,170 @@
+'''
+Point spread function metrics.
+
+Metrics are computed on a window cropped around the peak, so the cost
+does not depend on the sensor size. A PSFTable collects one row per
+wavelength and is saved next to the captured images, giving the
+PSF-versus-wavelength table directly from the sweep.
+'''
+
+import csv
+import os
+import numpy as np
+
+FIELDS = ('wavelength_nm', 'peak', 'peak_row', 'peak_col',
+          'centroid_row', 'centroid_col', 'sigma_row', 'sigma_col',
+          'fwhm_row', 'fwhm_col', 'background', 'total')
+
+NOISE_THRESHOLD = 3.0  # Noise sigmas for the first moment estimate
+MOMENT_RADIUS = 4.0  # Aperture radius in PSF sigmas
+APERTURE_ITERATIONS = 5
+
+
+def _moments(weights, rows, cols):
+    '''
+    @return: (centroid row, centroid col, sigma row, sigma col) of a
+             weight image, None if the weights have no positive sum or
+             variance
+    '''
+    row_sum = weights.sum(axis=1)
+    col_sum = weights.sum(axis=0)
+    total = row_sum.sum()
+    if total <= 0:
+        return None
+    cy = (rows * row_sum).sum() / total
+    cx = (cols * col_sum).sum() / total
+    var_row = ((rows - cy) ** 2 * row_sum).sum() / total
+    var_col = ((cols - cx) ** 2 * col_sum).sum() / total
+    if var_row <= 0 or var_col <= 0:
+        return None
+    return cy, cx, np.sqrt(var_row), np.sqrt(var_col)
+
+
+def _fwhm(profile):
+    '''
+    Full width at half maximum of a 1D profile, linearly interpolated.
+    @return: Width in pixels, nan if the profile does not fall below half
+    '''
+    i = int(np.argmax(profile))
+    half = profile[i] / 2.0
+    below = np.nonzero(profile < half)[0]
+    left = below[below < i]
+    right = below[below > i]
+    if left.size == 0 or right.size == 0:
+        return np.nan
+    l, r = left[-1], right[0]
+    # Interpolated crossing points of the half maximum
+    x_l = l + (half - profile[l]) / (profile[l + 1] - profile[l])
+    x_r = r - 1 + (profile[r - 1] - half) / (profile[r - 1] - profile[r])
+    return x_r - x_l
+
+
+def psf_metrics(frame, window=32, radii=(2, 4, 8), background=None):
+    '''
+    Computes PSF metrics of a frame.
+
+    @param frame: 2D ndarray
+    @param window: Half width of the analysis window around the peak
+    @param radii: Radii (pixels) for the encircled energy fractions
+    @param background: Background level; the median of the window border
+                       when None
+    @return: dict with FIELDS (except wavelength) and 'ee_<r>' for each
+             radius
+    '''
+    frame = np.asarray(frame)
+    peak_idx = np.unravel_index(np.argmax(frame), frame.shape)
+    r0 = max(peak_idx[0] - window, 0)
+    c0 = max(peak_idx[1] - window, 0)
+    win = frame[r0:peak_idx[0] + window + 1,
+                c0:peak_idx[1] + window + 1].astype(np.float64)
+    border = np.concatenate((win[0], win[-1], win[1:-1, 0], win[1:-1, -1]))
+    if background is None:
+        background = float(np.median(border))
+    win -= background
+    # Noise from the border spread. Pixels above a few sigma give a first
+    # estimate, the moments are then taken of the unclipped window inside
+    # an aperture of MOMENT_RADIUS sigma, where noise averages out instead
+    # of adding only its positive half.
+    noise = 1.4826 * float(np.median(np.abs(border - np.median(border))))
+    weights = np.where(win > NOISE_THRESHOLD * noise, win, 0.0)
+
+    rows = np.arange(win.shape[0], dtype=np.float64)
+    cols = np.arange(win.shape[1], dtype=np.float64)
+    result = {'peak': float(frame[peak_idx]),
+              'peak_row': int(peak_idx[0]),
+              'peak_col': int(peak_idx[1]),
+              'background': background}
+    moments = _moments(weights, rows, cols)
+    for _ in range(APERTURE_ITERATIONS if moments is not None else 0):
+        cy, cx, sy, sx = moments
+        radius = MOMENT_RADIUS * max(sy, sx, 0.5)
+        inside = (rows[:, None] - cy) ** 2 + (cols[None, :] - cx) ** 2 <= radius ** 2
+        aperture = np.where(inside, win, 0.0)
+        refined = _moments(aperture, rows, cols)
+        if refined is None:
+            break
+        moments, weights = refined, aperture
+    total = weights.sum()
+    result['total'] = float(total)
+    if moments is None or total <= 0:
+        for key in ('centroid_row', 'centroid_col', 'sigma_row', 'sigma_col',
+                    'fwhm_row', 'fwhm_col'):
+            result[key] = np.nan
+        for r in radii:
+            result['ee_%g' % r] = np.nan
+        return result
+
+    cy, cx, sy, sx = moments
+    result['centroid_row'] = float(r0 + cy)
+    result['centroid_col'] = float(c0 + cx)
+    result['sigma_row'] = float(sy)
+    result['sigma_col'] = float(sx)
+    pr, pc = peak_idx[0] - r0, peak_idx[1] - c0
+    result['fwhm_row'] = float(_fwhm(win[:, pc]))
+    result['fwhm_col'] = float(_fwhm(win[pr, :]))
+
+    r2 = (rows[:, None] - cy) ** 2 + (cols[None, :] - cx) ** 2
+    for r in radii:
+        result['ee_%g' % r] = float(weights[r2 <= r * r].sum() / total)
+    return result
+
+
+class PSFTable(object):
+    '''
+    PSF metrics per wavelength, appended to a CSV file as rows arrive.
+    '''
+
+    def __init__(self, filepath, window=32, radii=(2, 4, 8)):
+        '''
+        @param filepath: CSV file, e.g. '<output_dir>/psf_metrics.csv'
+        @param window: See psf_metrics()
+        @param radii: See psf_metrics()
+        '''
+        self.filepath = filepath
+        self.window = window
+        self.radii = tuple(radii)
+        self.fields = FIELDS + tuple('ee_%g' % r for r in self.radii)
+        self.rows = []
+        if not os.path.exists(filepath):
+            with open(filepath, 'w', newline='') as f:
+                csv.writer(f).writerow(self.fields)
+
+    def add(self, wavelength_nm, frame):
+        '''
+        Computes metrics of a frame and appends them to the table.
+        @return: dict of metrics
+        '''
+        row = psf_metrics(frame, self.window, self.radii)
+        row['wavelength_nm'] = wavelength_nm
+        self.rows.append(row)
+        with open(self.filepath, 'a', newline='') as f:
+            csv.writer(f).writerow([row[k] for k in self.fields])
+        return row
+
+    def as_array(self):
+        '''
+        @return: Structured numpy array of all rows
+        '''
+        dtype = [(k, np.float64) for k in self.fields]
+        return np.array([tuple(r[k] for k in self.fields) for r in self.rows],
+                        dtype=dtype)
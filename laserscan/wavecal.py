@@ -0,0 +1,191 @@
+'''
+Measured wavelength calibration.
+
+Frames are labelled with the commanded wavelength, which differs from
+what the laser emits. A WavelengthCalibration records commanded against
+measured wavelengths, from the laser's own :WAVelength? reading or from
+an external wavemeter, and keeps them in one JSON file per laser. The
+measured offset is linearly interpolated over the commanded wavelength,
+vectorized with np.interp, to
+
+  - label frames and cubes with the emitted wavelength (measured()),
+  - pre-compensate commands, so the laser emits the wanted wavelength
+    (command_for()).
+
+Once the table covers a scan range, later scans are labelled from the
+table and need no read-back per point (covers()).
+
+Example:
+    cal = WavelengthCalibration.for_laser('calibrations', 'GPIB0::1::INSTR')
+    cal.record(1550.0, laser.wavelength)
+    cal.save()
+    emitted = cal.measured(cube_wavelengths)
+'''
+
+import csv
+import json
+import os
+import re
+import time
+import numpy as np
+
+SOURCES = ('wavemeter', 'readback')  # Preferred first
+
+
+class WavelengthCalibration(object):
+
+    def __init__(self, path, laser_id=''):
+        '''
+        @param path: JSON file of the table, loaded if it exists
+        @param laser_id: Laser identification stored with the table
+        '''
+        self.path = path
+        self.laser_id = laser_id
+        self.points = []  # [commanded nm, measured nm, source, time]
+        self._table = None  # (commanded, offset) arrays, see _fit()
+        if os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def for_laser(cls, directory, laser_id):
+        '''
+        Opens the table of a laser in a directory of tables.
+        @param laser_id: e.g. the VISA resource name or *IDN? reply
+        '''
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9.-]+', '_', laser_id).strip('_')
+        return cls(os.path.join(directory, 'wavelength_%s.json' % name),
+                   laser_id)
+
+    def record(self, commanded, measured, source='readback'):
+        '''
+        Adds a commanded/measured pair.
+        @param source: 'readback' (:WAVelength?) or 'wavemeter'
+        '''
+        if source not in SOURCES:
+            raise Exception('Unknown wavelength source %s' % str(source))
+        self.points.append([float(commanded), float(measured), source,
+                            time.time()])
+        self._table = None
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        self.laser_id = data.get('laser', self.laser_id)
+        self.points = data['points']
+        self._table = None
+
+    def save(self):
+        '''
+        Writes the table atomically.
+        '''
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'laser': self.laser_id,
+                       'fields': ['commanded_nm', 'measured_nm', 'source', 'time'],
+                       'points': self.points}, f, indent=0)
+        os.replace(tmp, self.path)
+
+    def _fit(self):
+        '''
+        Builds the lookup table from the points of the best source:
+        unique commanded wavelengths and their mean measured offsets.
+        @return: (commanded, offset) arrays, None if there are no points
+        '''
+        if self._table is None and self.points:
+            for source in SOURCES:
+                pts = [p for p in self.points if p[2] == source]
+                if pts:
+                    break
+            pts = np.array([p[:2] for p in pts], dtype=np.float64)
+            # Round, so repeated commands of the same value are averaged
+            commanded, inverse = np.unique(np.round(pts[:, 0], 4),
+                                           return_inverse=True)
+            offset = np.bincount(inverse, weights=pts[:, 1] - pts[:, 0]) \
+                / np.bincount(inverse)
+            self._table = (commanded, offset)
+        return self._table
+
+    def offset(self, commanded):
+        '''
+        Measured minus commanded wavelength, constant beyond the ends of
+        the table, zero without a table.
+        '''
+        commanded = np.asarray(commanded, dtype=np.float64)
+        table = self._fit()
+        if table is None:
+            return np.zeros_like(commanded)
+        return np.interp(commanded, *table)
+
+    def measured(self, commanded):
+        '''
+        @param commanded: Wavelength(s) in nm, scalar or array
+        @return: Emitted wavelength(s) in nm
+        '''
+        commanded = np.asarray(commanded, dtype=np.float64)
+        return commanded + self.offset(commanded)
+
+    def command_for(self, target, iterations=4):
+        '''
+        Pre-compensated command that makes the laser emit the target.
+        Solves c + offset(c) = target by fixed point iteration, which
+        converges for the slowly varying offsets of a laser.
+        @param target: Wavelength(s) in nm, scalar or array
+        '''
+        target = np.asarray(target, dtype=np.float64)
+        command = target - self.offset(target)
+        for _ in range(iterations - 1):
+            command = target - self.offset(command)
+        return command
+
+    def covers(self, start, stop, max_gap=1.0):
+        '''
+        @return: True if the table spans start..stop with no gap between
+                 points wider than max_gap nm, so the scan can be
+                 labelled without read-back
+        '''
+        table = self._fit()
+        if table is None:
+            return False
+        commanded = table[0]
+        lo, hi = min(start, stop), max(start, stop)
+        if commanded[0] > lo or commanded[-1] < hi:
+            return False
+        inside = commanded[(commanded >= lo) & (commanded <= hi)]
+        edges = np.concatenate(([lo], inside, [hi]))
+        return bool(np.max(np.diff(edges)) <= max_gap)
+
+
+LABELS_NAME = 'wavelength_labels.csv'
+
+
+def log_label(output_dir, name, commanded, measured, source):
+    '''
+    Appends the wavelength label of a frame to wavelength_labels.csv.
+    @param source: 'readback', 'wavemeter' or 'table'
+    '''
+    path = os.path.join(output_dir, LABELS_NAME)
+    new = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(('name', 'commanded_nm', 'measured_nm', 'source'))
+        writer.writerow((name, '%.4f' % commanded, '%.4f' % measured, source))
+
+
+def read_labels(folder):
+    '''
+    Reads the wavelength labels written by log_label() during a scan.
+    These already account for pre-compensated commands, so they are the
+    labels to use for the frames of that folder.
+    @return: dict of frame name: (measured nm, source), empty if the
+             folder has no labels file
+    '''
+    path = os.path.join(folder, LABELS_NAME)
+    labels = {}
+    if not os.path.exists(path):
+        return labels
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            labels[row['name']] = (float(row['measured_nm']), row['source'])
+    return labels
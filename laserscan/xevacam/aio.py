@@ -0,0 +1,156 @@
+'''
+asyncio interface to XevaCam.
+
+All blocking DLL calls of a camera run on one dedicated executor thread,
+which also serializes them, so an event loop can talk to the camera, the
+laser and the UI at the same time:
+
+    async def scan(cam, laser, wavelengths):
+        acam = AsyncCamera(cam)
+        async with acam.stream(maxsize=4) as frames:
+            async for frame in frames:
+                save = asyncio.to_thread(np.save, path, frame.data)
+                step = asyncio.to_thread(laser.write, ':OUTP:SCAN:STEP')
+                await asyncio.gather(save, step)
+        acam.close()
+
+or simply `async with cam.stream() as frames`, see XevaCam.stream().
+
+A stream reads frames with XevaCam.capture_frame_only() in a producer
+task, one executor job per frame, into a bounded queue. When the queue is
+full the producer waits (back pressure), or with drop_oldest the oldest
+frame is discarded so the consumer always sees recent frames. Other calls
+made with AsyncCamera.run() interleave with the frame reads.
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+import numpy as np
+
+import laserscan.xevacam.utils as utils
+
+# data: ndarray (height, width), time: ns (utils.get_time_ns()),
+# index: frame number in the stream, duplicate: repeated frame flag
+Frame = collections.namedtuple('Frame', ('data', 'time', 'index', 'duplicate'))
+
+_END = object()  # Queue sentinel
+
+
+class AsyncCamera(object):
+
+    def __init__(self, cam):
+        '''
+        @param cam: XevaCam (or CameraSession), opened
+        '''
+        self.cam = cam
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='xevacam')
+
+    async def run(self, func, *args):
+        '''
+        Runs a blocking camera call on the camera thread, e.g.
+        await acam.run(cam.set_property, 5000, None, 'IntegrationTime')
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def capture(self):
+        '''
+        Reads one frame.
+        @return: Frame
+        '''
+        return await self.run(self._read, 0)
+
+    def _read(self, index):
+        # Camera thread: one frame as an ndarray
+        buffer, size, dims = self.cam.capture_frame_only()
+        t = utils.get_time_ns()
+        dtype = self.cam.get_pixel_dtype()
+        data = np.frombuffer(buffer, dtype=dtype).reshape(dims)
+        return Frame(data, t, index, self.cam.last_frame_duplicate)
+
+    def stream(self, maxsize=4, drop_oldest=False, count=None):
+        '''
+        @param maxsize: Frames buffered between the camera and the loop
+        @param drop_oldest: Discard the oldest frame when the buffer is
+                            full instead of pausing the camera reads
+        @param count: Stop after this many frames, endless when None
+        @return: FrameStream, an async context manager
+        '''
+        return FrameStream(self, maxsize, drop_oldest, count)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class FrameStream(object):
+    '''
+    Async iterator of Frame tuples. Use with `async with`, which starts
+    and stops the producer task.
+    '''
+
+    def __init__(self, acam, maxsize=4, drop_oldest=False, count=None):
+        self.acam = acam
+        self.drop_oldest = drop_oldest
+        self.count = count
+        self._queue = asyncio.Queue(maxsize)
+        self._task = None
+        self.frames = 0
+        self.dropped = 0  # Discarded with drop_oldest
+
+    async def __aenter__(self):
+        self._task = asyncio.get_running_loop().create_task(self._produce())
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+        return False
+
+    async def stop(self):
+        '''
+        Stops the producer after the frame being read.
+        '''
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _produce(self):
+        name = 'FrameStream'
+        try:
+            while self.count is None or self.frames < self.count:
+                frame = await self.acam.run(self.acam._read, self.frames)
+                self.frames += 1
+                if self.drop_oldest and self._queue.full():
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                await self._queue.put(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(name, 'Frame read failed: %s' % str(e))
+            await self._queue.put(e)
+            return
+        await self._queue.put(_END)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is _END:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def backlog(self):
+        '''
+        Frames waiting for the consumer.
+        '''
+        return self._queue.qsize()
@@ -4,6 +4,7 @@ Created on 9.11.2016
 @author: Samuli Rahkonen
 '''
 
+import os
 import numpy as np
 import laserscan.xevacam.xevadll as xdll
 from contextlib import contextmanager
@@ -12,7 +13,12 @@ import queue
 import sys
 import time
 import struct
+import collections
+import json
 import laserscan.xevacam.utils as utils
+from laserscan.xevacam.fingerprint import FrameFingerprinter
+from laserscan.xevacam.aio import AsyncCamera
+from laserscan.xevacam.delivery import HandlerQueue, FrameDispatcher
 from laserscan.xevacam.utils import kbinterrupt_decorate
 
 '''
@@ -25,6 +31,84 @@ class ExceptionThread(threading.Thread):
 '''
 
 
+class CaptureStats(object):
+    '''
+    Frame counters updated by the capture thread and read by others.
+
+    Dropped frames are detected from frame intervals: an interval longer
+    than drop_factor times the running average counts as missed frames.
+    '''
+
+    def __init__(self, drop_factor=1.5, warmup=8, smoothing=0.05):
+        '''
+        @param drop_factor: Interval / average ratio regarded as a drop
+        @param warmup: Frames used to settle the average before detecting
+        @param smoothing: Weight of the newest interval in the average
+        '''
+        self.drop_factor = drop_factor
+        self.warmup = warmup
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Resets counters. Call from the capture thread, since the CPU time
+        is measured with time.thread_time_ns().
+        '''
+        with self._lock:
+            self.frames = 0
+            self.dropped = 0
+            self.duplicates = 0  # Repeated frames, flagged or dropped
+            self.interval_avg = 0.0  # ns
+            self.cpu_time = 0  # ns
+            self._last = None
+            self._cpu_start = time.thread_time_ns()
+
+    def update(self, t):
+        '''
+        Registers a captured frame.
+        @param t: Frame time stamp in nanoseconds
+        '''
+        with self._lock:
+            if self._last is not None:
+                dt = t - self._last
+                if self.frames <= self.warmup:
+                    # Plain running mean until the average has settled
+                    self.interval_avg += (dt - self.interval_avg) / self.frames
+                else:
+                    if dt > self.drop_factor * self.interval_avg:
+                        missed = max(1, int(round(dt / self.interval_avg)) - 1)
+                        self.dropped += missed
+                        dt /= missed + 1
+                    self.interval_avg += self.smoothing * (dt - self.interval_avg)
+            self._last = t
+            self.frames += 1
+            self.cpu_time = time.thread_time_ns() - self._cpu_start
+
+    def max_backoff(self):
+        '''
+        Longest sleep between polls, a quarter of the frame interval.
+        @return: seconds
+        '''
+        if self.interval_avg <= 0:
+            return utils.POLL_BACKOFF_MAX
+        return min(utils.POLL_BACKOFF_MAX,
+                   max(utils.POLL_BACKOFF_MIN, self.interval_avg * 0.25e-9))
+
+    def snapshot(self):
+        '''
+        @return: dict with 'frames', 'dropped', 'duplicates',
+                 'interval_avg_ms' and 'cpu_time_s' of the capture thread
+        '''
+        with self._lock:
+            return {'frames': self.frames,
+                    'dropped': self.dropped,
+                    'duplicates': self.duplicates,
+                    'interval_avg_ms': self.interval_avg * 1e-6,
+                    'cpu_time_s': self.cpu_time * 1e-9}
+
+
 class XevaCam(object):
 
     def __init__(self, calibration=''):
@@ -35,42 +119,190 @@ class XevaCam(object):
         '''
         self.handle = 0
         self.calibration = calibration.encode('utf-8')  # Path to .xca file
+        self.camera_path = None
+        self.sw_correction = True
+        # (path, mtime, flag) of the calibration loaded on the open handle
+        self._calibration_state = None
+        self.reconnects = 0
 
         # Involve threading
         self._enabled = False
         self.enabled_lock = threading.Lock()
         self.handlers = []  # For streams, objects with write() method
+        self._handler_options = []  # Delivery options, parallel to handlers
+        self._dispatcher = None  # FrameDispatcher of the latest recording
         # Exception queue for checking if an exception occurred inside thread
         self.exc_queue = queue.Queue()
         self._capture_thread = threading.Thread(name='capture_thread',
                                                 target=self.capture_frame_stream)
                                         # args=(self.handlers))
         self._record_time = 0  # Used for measuring the overall recording time
-        self._times = []  # Used for saving time stamps for each frame
+        # Preallocated frame time stamps (ns since recording start)
+        self._times = np.zeros(utils.TIMESTAMP_CHUNK, dtype=np.uint64)
+        # Fingerprint of each recorded frame, parallel to _times
+        self._fingerprints = np.zeros(utils.TIMESTAMP_CHUNK, dtype=np.uint64)
+        # 1 for frames whose fingerprint repeats a recent one, parallel to
+        # _times. A static scene (dark, saturated) repeats too, so such
+        # frames are flagged and recorded unless drop_duplicates is set.
+        self._repeated = np.zeros(utils.TIMESTAMP_CHUNK, dtype=np.uint8)
+        self.drop_duplicates = False
+        self._times_count = 0
+        self.record_start_ns = 0  # utils.get_time_ns() at recording start
+        # Detects repeated frames, see capture_frame_only()
+        self.fingerprinter = FrameFingerprinter()
+        self.refetch = 2  # Attempts to replace a repeated frame
+        self.last_fingerprint = None
+        self.last_frame_duplicate = False
+        # Live counters of the capture thread, see get_capture_stats()
+        self.stats = CaptureStats()
+        # DLL error counts by XDLL.errcodes name
+        self.error_counts = collections.Counter()
+        # Region of interest (row, col, height, width) cropped in software,
+        # None when disabled or done by the camera, see set_roi()
+        self.roi = None
+        self._roi_dtype = None
+        # Requested readout frame type, FT_NATIVE reads the camera's own
+        # format without conversion, see set_frame_type()
+        self.frame_type = xdll.XDLL.FT_NATIVE
+        self._hw_roi_restore = None  # Property values before hardware ROI
+        # Static property names, ranges and units, see property_catalog()
+        self._property_catalog = None
+        self._property_buffers = xdll.PropertyBuffers()
+        # Last written property values, for skipping unchanged writes
+        self._property_values = {}
+        self._batch_depth = 0
+        self._batch_dirty = False
+        self._aio = None  # AsyncCamera, see stream()
 
 
     def open(self, camera_path='cam://0', sw_correction=True):
         '''
-        Opens connection to the camera.
-        '''
-        # Existing implementation
-        pass
-
-    def start_capture(self, camera_path='cam://0', sw_correction=True):
-        '''
-        Starts the camera once, keeping it ready for capturing.
+        Opens connection to the camera. An open, initialised handle to the
+        same camera is kept, only a changed calibration is loaded again.
+        @return: True if a new handle was opened
         '''
+        self.sw_correction = sw_correction
+        if self.camera_path == camera_path and self.is_open():
+            self._load_calibration()
+            return False
+        if self.handle:
+            self._release_handle()
         self.handle = xdll.XDLL.open_camera(camera_path.encode('utf-8'), 0, 0)
         if self.handle == 0:
             raise Exception('Camera handle is NULL. Initialization failed.')
         if not xdll.XDLL.is_initialised(self.handle):
+            self._release_handle()
             raise Exception('Camera initialization failed.')
-        if self.calibration:
-            flag = xdll.XDLL.XLC_StartSoftwareCorrection if sw_correction else 0
-            error = xdll.XDLL.load_calibration(self.handle, self.calibration, flag)
-            if error != xdll.XDLL.I_OK:
-                raise Exception(f'Calibration load failed: {xdll.error2str(error)}')
-        print('Camera started and initialized successfully.')
+        if camera_path != self.camera_path:
+            self._property_catalog = None  # Another camera
+        self.camera_path = camera_path
+        self._load_calibration()
+        return True
+
+    def start_capture(self, camera_path='cam://0', sw_correction=True):
+        '''
+        Starts the camera once, keeping it ready for capturing.
+        '''
+        if self.open(camera_path, sw_correction):
+            print('Camera started and initialized successfully.')
+
+    def is_open(self):
+        '''
+        @return: True if the handle is valid and initialised
+        '''
+        return bool(self.handle) and bool(xdll.XDLL.is_initialised(self.handle))
+
+    def set_calibration(self, calibration):
+        '''
+        Changes the calibration file (.xca), loaded at once if the camera
+        is open.
+        '''
+        self.calibration = calibration.encode('utf-8')
+        if self.is_open():
+            self._load_calibration()
+
+    def _load_calibration(self):
+        '''
+        Loads the calibration unless the same file, unmodified, is already
+        loaded on this handle.
+        @return: True if loaded
+        '''
+        if not self.calibration:
+            return False
+        flag = xdll.XDLL.XLC_StartSoftwareCorrection if self.sw_correction else 0
+        try:
+            mtime = os.path.getmtime(self.calibration)
+        except OSError:
+            mtime = None  # Let the DLL report the problem
+        state = (self.calibration, mtime, flag)
+        if state == self._calibration_state:
+            return False
+        error = xdll.XDLL.load_calibration(self.handle, self.calibration, flag)
+        if error != xdll.XDLL.I_OK:
+            self.count_error(error)
+            self._calibration_state = None
+            raise Exception(f'Calibration load failed: {xdll.error2str(error)}')
+        self._calibration_state = state
+        return True
+
+    def _release_handle(self):
+        # Closes the handle, ignoring errors of an already broken connection
+        try:
+            if xdll.XDLL.is_capturing(self.handle):
+                xdll.XDLL.stop_capture(self.handle)
+            xdll.XDLL.close_camera(self.handle)
+        except Exception as e:
+            print('close', 'Ignored while closing: %s' % str(e))
+        self.handle = 0
+        self._calibration_state = None
+
+    def handle_lost(self, exc=None):
+        '''
+        Tells whether an error means the handle has to be reopened.
+        @param exc: Exception raised by a camera call, optional
+        '''
+        if exc is not None and any(e in str(exc) for e in utils.HANDLE_ERRORS):
+            return True
+        try:
+            return not self.is_open()
+        except Exception:
+            return True
+
+    def reconnect(self, retries=5, delay=1.0):
+        '''
+        Reopens the camera after a connection fault, without restarting
+        the application. The calibration and the properties written
+        with set_property() are restored on the new handle.
+
+        @param retries: Attempts to open the camera
+        @param delay: Seconds between attempts
+        '''
+        name = 'reconnect'
+        if self.camera_path is None:
+            raise Exception('Camera was never opened.')
+        if self.is_alive():
+            self.enabled = False
+            self._capture_thread.join(5)
+        start = time.monotonic()
+        self._release_handle()
+        for attempt in range(retries):
+            try:
+                self.open(self.camera_path, self.sw_correction)
+                break
+            except Exception as e:
+                print(name, 'Attempt %d failed: %s' % (attempt, str(e)))
+                time.sleep(delay)
+        else:
+            raise Exception('Camera did not reconnect after %d attempts.' % retries)
+        # Property catalog and values belong to the old handle
+        restore = [(n, v, t) for n, (t, v) in self._property_values.items()]
+        self._property_catalog = None
+        self._property_values = {}
+        self.fingerprinter.reset()
+        if restore:
+            self.set_properties(restore)
+        self.reconnects += 1
+        print(name, 'Reconnected in %.1f s' % (time.monotonic() - start))
 
     def capture_single_frame(self, dump_buffer=False):
         '''
@@ -89,21 +321,37 @@ class XevaCam(object):
         if not xdll.XDLL.is_capturing(self.handle):
             error = xdll.XDLL.start_capture(self.handle)
             if error != xdll.XDLL.I_OK:
+                self.count_error(error)
                 raise Exception(f'{name}: Starting capture failed: {xdll.error2str(error)}')
 
-        size = self.get_frame_size()
-        dims = self.get_frame_dims()
-        frame_t = self.get_frame_type()
+        size = self._raw_frame_size()
+        dims = self._raw_frame_dims()
+        frame_t, readout_flag = self.get_readout()
         frame_buffer = bytes(size)
+        pixels = np.frombuffer(frame_buffer, dtype=self.get_pixel_dtype())
+
+        for attempt in range(self.refetch + 1):
+            ok = self.get_frame(
+                frame_buffer,
+                frame_t=frame_t,
+                size=size,
+                flag=xdll.XDLL.XGF_Blocking | readout_flag
+            )
+            if not ok:
+                raise Exception(f'{name}: Failed to capture frame.')
+            fp = self.fingerprinter.fingerprint(pixels)
+            duplicate = self.fingerprinter.check(fp)
+            if not duplicate:
+                break
+            print(name, 'Repeated frame %016x, attempt %d' % (fp, attempt))
+        # Still set if refetching did not help, callers can flag the frame
+        self.last_fingerprint = fp
+        self.last_frame_duplicate = duplicate
 
-        ok = self.get_frame(
-            frame_buffer,
-            frame_t=frame_t,
-            size=size,
-            flag=xdll.XDLL.XGF_Blocking
-        )
-        if not ok:
-            raise Exception(f'{name}: Failed to capture frame.')
+        if self.roi is not None:
+            view = np.frombuffer(frame_buffer, dtype=self._roi_dtype).reshape(dims)
+            frame_buffer = view[self._roi_slices()].tobytes()
+            return frame_buffer, len(frame_buffer), self.roi[2:]
 
         return frame_buffer, size, dims
 
@@ -111,8 +359,34 @@ class XevaCam(object):
         '''
         Stops capturing, closes capture thread, closes connection.
         '''
-        # Existing implementation
-        pass
+        if self.is_alive():
+            self.stop_recording()
+        if self._aio is not None:
+            self._aio.close()
+            self._aio = None
+        if self.handle:
+            self._release_handle()
+        self._property_values = {}
+
+
+    def stream(self, maxsize=4, drop_oldest=False, count=None):
+        '''
+        asyncio frame stream, see aio.AsyncCamera.stream():
+
+            async with cam.stream() as frames:
+                async for frame in frames:
+                    ...
+        '''
+        return self.aio().stream(maxsize, drop_oldest, count)
+
+
+    def aio(self):
+        '''
+        @return: The AsyncCamera running this camera's blocking calls
+        '''
+        if self._aio is None:
+            self._aio = AsyncCamera(self)
+        return self._aio
 
 
     @property
@@ -140,6 +414,21 @@ class XevaCam(object):
         return self._capture_thread.is_alive()
 
 
+    def count_error(self, error):
+        '''
+        Registers a DLL error code for monitoring.
+        '''
+        self.error_counts[xdll.XDLL.errcodes.get(error, str(error))] += 1
+
+
+    def get_capture_stats(self):
+        '''
+        Live counters of the capture thread. Safe to call while recording.
+        @return: dict, see CaptureStats.snapshot()
+        '''
+        return self.stats.snapshot()
+
+
     def get_property_count(self):
         '''
         Asks the camera how many properties there are.
@@ -161,6 +450,11 @@ class XevaCam(object):
         '''
         if not name:
             name = self.get_property_name(idx)
+        if self._property_catalog is not None and name in self._property_catalog:
+            # Range and unit are static, only the value is read
+            value = self._property_buffers.value(self.handle, name.encode('utf-8'))
+            static = self._property_catalog[name]
+            return name, value.decode('utf-8'), static['range'], static['unit']
         name = name.encode('utf-8')
 
         info = xdll.get_property_info(self.handle, name)
@@ -168,23 +462,143 @@ class XevaCam(object):
         return tuple(i.decode('utf-8') for i in info)
 
 
+    def property_catalog(self):
+        '''
+        Enumerates all properties once and caches their names, ranges and
+        units, which are static for a given camera.
+        @return: dict name -> {'range': str, 'unit': str}
+        '''
+        if self._property_catalog is None:
+            buffers = self._property_buffers
+            catalog = {}
+            for idx in range(self.get_property_count()):
+                name = buffers.name(self.handle, idx)
+                catalog[name.decode('utf-8')] = {
+                    'range': buffers.range(self.handle, name).decode('utf-8'),
+                    'unit': buffers.unit(self.handle, name).decode('utf-8')}
+            self._property_catalog = catalog
+        return self._property_catalog
+
+
+    def snapshot_properties(self):
+        '''
+        Reads the current value of every property, one DLL call each.
+        @return: dict name -> value string
+        '''
+        buffers = self._property_buffers
+        values = {}
+        for name in self.property_catalog():
+            try:
+                values[name] = buffers.value(self.handle, name.encode('utf-8')).decode('utf-8')
+            except Exception:
+                # Some properties are not readable in every state
+                values[name] = None
+        return values
+
+
+    def save_properties(self, filepath):
+        '''
+        Writes the full camera state as a compact JSON sidecar file.
+        @param filepath: e.g. '<output_dir>/camera_state.json'
+        '''
+        catalog = self.property_catalog()
+        values = self.snapshot_properties()
+        state = {name: [values[name], info['range'], info['unit']]
+                 for name, info in catalog.items()}
+        with open(filepath, 'w') as f:
+            json.dump({'fields': ['value', 'range', 'unit'],
+                       'properties': state}, f, separators=(',', ':'))
+
+
     def set_property(self, value, idx = None, name = None, propType = "num"):
         '''
-        Sets numerical property
+        Sets numerical property. Writes are skipped when the property
+        already has the value. Inside batch_properties() the frame buffer
+        is flushed once at the end instead of after every write.
+        @return: True if the property was written
         '''
         if not name:
             name = self.get_property_name(idx)
-        name = name.encode('utf-8')
+        if self._property_unchanged(name, value, propType):
+            return False
+        bname = name.encode('utf-8')
 
         if propType == "num":
-            xdll.set_num_property(self.handle, name, value)
+            xdll.set_num_property(self.handle, bname, value)
         elif propType == "bool":
-            xdll.set_num_property(self.handle, name, value, boolean = True)
+            xdll.set_num_property(self.handle, bname, value, boolean = True)
         else:
-            xdll.set_char_property(self.handle, name, value)
+            xdll.set_char_property(self.handle, bname, value)
+        self._property_values[name] = (propType, value)
 
-        # Dump frame buffer
-        self.capture_single_frame()
+        if self._batch_depth:
+            self._batch_dirty = True
+        else:
+            # Dump frame buffer
+            self.capture_single_frame()
+        return True
+
+
+    def _property_unchanged(self, name, value, propType):
+        '''
+        Compares a new value with the last one written, or with the value
+        read from the camera when nothing was written yet.
+        '''
+        cached = self._property_values.get(name)
+        if cached is not None:
+            current = cached[1]
+        else:
+            try:
+                current = self.get_property_info(name=name)[1]
+            except Exception:
+                return False  # Not readable, always write
+        try:
+            if propType == "num":
+                return float(current) == float(value)
+            if propType == "bool":
+                return bool(int(float(current))) == bool(value)
+        except (TypeError, ValueError):
+            return False
+        if isinstance(current, str):
+            current = current.encode('utf-8')
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        return current == value
+
+
+    @contextmanager
+    def batch_properties(self):
+        '''
+        Context manager applying several property changes with a single
+        frame buffer flush at the end, e.g.
+
+            with cam.batch_properties():
+                cam.set_property(1, name='LowGain', propType='bool')
+                cam.set_property(5000, name='IntegrationTime')
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._batch_dirty:
+                self._batch_dirty = False
+                # Dump frame buffer once for all changes
+                self.capture_single_frame()
+
+
+    def set_properties(self, properties):
+        '''
+        Sets several properties with a single flush.
+        @param properties: Iterable of (name, value, propType) tuples
+        @return: Names of the properties that were written
+        '''
+        written = []
+        with self.batch_properties():
+            for name, value, propType in properties:
+                if self.set_property(value, name=name, propType=propType):
+                    written.append(name)
+        return written
 
 
     def get_frame_parameters(self):
@@ -199,23 +613,117 @@ class XevaCam(object):
     def get_frame_size(self):
         '''
         Asks the camera what is the frame size in bytes.
+        With a software ROI, the size of the cropped frame.
         @return: c_ulong
         '''
-        frame_size = xdll.XDLL.get_frame_size(self.handle)  # Size in bytes
-        return frame_size
+        if self.roi is not None:
+            return self.roi[2] * self.roi[3] * np.dtype(self._roi_dtype).itemsize
+        return self._raw_frame_size()
 
 
     def get_frame_dims(self):
         '''
         Returns frame dimensions in tuple(height, width).
+        With a software ROI, the dimensions of the cropped frame.
         @return: tuple (c_ulong, c_ulong)
         '''
+        if self.roi is not None:
+            return self.roi[2:]
+        return self._raw_frame_dims()
+
+
+    def _raw_frame_size(self):
+        # Size in bytes of the frames read from the DLL
+        if self._readout_type() == xdll.XDLL.get_frame_type(self.handle):
+            return xdll.XDLL.get_frame_size(self.handle)
+        height, width = self._raw_frame_dims()
+        return height * width * xdll.XDLL.pixel_sizes[self.frame_type]
+
+
+    def _raw_frame_dims(self):
+        # Dimensions of the frames read from the DLL
         frame_width = xdll.XDLL.get_frame_width(self.handle)
         frame_height = xdll.XDLL.get_frame_height(self.handle)
-        # print('width:', frame_width, 'height:', frame_height)
         return frame_height, frame_width
 
 
+    def has_property(self, name):
+        '''
+        Checks whether the camera has a property. Names are enumerated once.
+        '''
+        return name in self.property_catalog()
+
+
+    def set_roi(self, row, col, height, width, hardware=True):
+        '''
+        Restricts frames to a region of interest.
+
+        The camera's own window (utils.ROI_PROPERTIES) is used when it
+        exists, so that less data leaves the camera. Otherwise frames are
+        cropped right after XC_GetFrame, before any handler, copy or save.
+
+        @param row, col: Top left corner in sensor pixels
+        @param height, width: Size of the region
+        @param hardware: Try the camera window first
+        '''
+        self.clear_roi()
+        sensor = self._raw_frame_dims()
+        if row < 0 or col < 0 or row + height > sensor[0] or col + width > sensor[1]:
+            raise Exception('ROI %s outside of frame %s' % (
+                str((row, col, height, width)), str(sensor)))
+        if hardware and all(self.has_property(p) for p in utils.ROI_PROPERTIES):
+            names = utils.ROI_PROPERTIES
+            restore = [(n, float(self.get_property_info(name=n)[1]))
+                       for n in names]
+            try:
+                # Shrink first, so the offsets stay inside the sensor
+                self.set_properties(
+                    (n, v, 'num') for n, v in
+                    zip(names[2:] + names[:2], (width, height, col, row)))
+                self._hw_roi_restore = restore
+                print('set_roi', 'Camera window %s' % str((row, col, height, width)))
+                return
+            except Exception as e:
+                print('set_roi', 'Camera window failed, cropping in software: %s' % str(e))
+                self._hw_roi_restore = restore
+                self.clear_roi()
+        self._roi_dtype = self.get_pixel_dtype()
+        self.roi = (int(row), int(col), int(height), int(width))
+
+
+    def auto_roi(self, half_size=32, hardware=True):
+        '''
+        Locks a square ROI around the brightest pixel of a new frame.
+        @return: ROI tuple (row, col, height, width)
+        '''
+        self.clear_roi()
+        frame_buffer, size, dims = self.capture_frame_only()
+        frame = np.frombuffer(frame_buffer, dtype=self.get_pixel_dtype()).reshape(dims)
+        peak = np.unravel_index(np.argmax(frame), dims)
+        row = min(max(peak[0] - half_size, 0), max(dims[0] - 2 * half_size, 0))
+        col = min(max(peak[1] - half_size, 0), max(dims[1] - 2 * half_size, 0))
+        roi = (row, col, min(2 * half_size, dims[0]), min(2 * half_size, dims[1]))
+        self.set_roi(*roi, hardware=hardware)
+        return roi
+
+
+    def clear_roi(self):
+        '''
+        Returns to full frames.
+        '''
+        self.roi = None
+        if self._hw_roi_restore is not None:
+            restore = self._hw_roi_restore
+            self._hw_roi_restore = None
+            # Offsets come first in ROI_PROPERTIES, so the size fits again
+            self.set_properties((n, v, 'num') for n, v in restore)
+
+
+    def _roi_slices(self):
+        row, col, height, width = self.roi
+        return slice(row, row + height), slice(col, col + width)
+
+
     def get_frame_type(self):
         '''
         Returns enumeration of camera's frame type.
@@ -224,6 +732,60 @@ class XevaCam(object):
         return xdll.XDLL.get_frame_type(self.handle)
 
 
+    def set_frame_type(self, frame_t):
+        '''
+        Selects the frame type frames are read in.
+
+        @param frame_t: xdll.XDLL.FT_NATIVE (default) reads the camera's
+                        native format. Without software correction it is
+                        read with XGF_NoConversion, so the DLL only
+                        copies the frame, see get_readout(). Other FT_*
+                        types, e.g. FT_16_BPP_GRAY, are converted by the
+                        DLL on every read.
+        '''
+        if xdll.XDLL.pixel_sizes.get(frame_t) is None or \
+                frame_t == xdll.XDLL.FT_UNKNOWN:
+            raise Exception('Unsupported frame type %s' % str(frame_t))
+        if self.is_alive():
+            raise Exception('Can\'t change the frame type while recording')
+        self.frame_type = frame_t
+        if self.roi is not None:
+            self._roi_dtype = self.get_pixel_dtype()
+
+
+    def _readout_type(self):
+        # Frame type of the pixels in the read buffers
+        if self.frame_type == xdll.XDLL.FT_NATIVE:
+            return xdll.XDLL.get_frame_type(self.handle)
+        return self.frame_type
+
+
+    def software_correction_active(self):
+        '''
+        @return: True if a calibration is loaded with
+                 XLC_StartSoftwareCorrection on the open handle
+        '''
+        return self._calibration_state is not None and \
+            self._calibration_state[2] == xdll.XDLL.XLC_StartSoftwareCorrection
+
+
+    def get_readout(self):
+        '''
+        Frame type and flag to pass to get_frame(). The native type is
+        requested as FT_NATIVE with XGF_NoConversion, unless software
+        correction is active: the Xeneth correction filters may run in
+        the conversion step, so the native type is then requested
+        explicitly and converted, as before XGF_NoConversion was used.
+        @return: (frame type, flag)
+        '''
+        native = xdll.XDLL.get_frame_type(self.handle)
+        if self.frame_type in (xdll.XDLL.FT_NATIVE, native):
+            if self.software_correction_active():
+                return native, 0
+            return xdll.XDLL.FT_NATIVE, xdll.XDLL.XGF_NoConversion
+        return self.frame_type, 0
+
+
     def get_pixel_dtype(self):
         '''
         Returns numpy dtype of the camera's configured data type for frame
@@ -235,7 +797,7 @@ class XevaCam(object):
             pixel_dtype = conversions[bytes_in_pixel]
         except:
             raise Exception('Unsupported pixel size %s' % str(bytes_in_pixel))
-        if conversions is None:
+        if pixel_dtype is None:
             raise Exception('Unsupported pixel size %s' % str(bytes_in_pixel))
         return pixel_dtype
 
@@ -245,8 +807,7 @@ class XevaCam(object):
         Returns a frame pixel's size in bytes.
         @return: int
         '''
-        frame_t = xdll.XDLL.get_frame_type(self.handle)
-        return xdll.XDLL.pixel_sizes[frame_t]
+        return xdll.XDLL.pixel_sizes[self._readout_type()]
 
 
     def get_frame(self, buffer, frame_t, size, flag=0):
@@ -255,8 +816,8 @@ class XevaCam(object):
 
         @param buffer: bytes buffer (output) to which a frame is read from
                        the camera.
-        @param frame_t: frame type enumeration. Use get_frame_type() to find
-                        the native type.
+        @param frame_t: frame type enumeration. Use get_readout() to find
+                        the type and flag of the selected readout.
         @param size: frame size in bytes. Use get_frame_dims()
         @param flag: Type of execution. 0 is non-blocking, xdll.XGF_Blocking
                      is blocking.
@@ -274,31 +835,51 @@ class XevaCam(object):
                                     size)
         # ctypes.cast(buffer, ctypes.POINTER(ctypes.c))
         if error not in (xdll.XDLL.I_OK, xdll.XDLL.E_NO_FRAME):
+            self.count_error(error)
             raise Exception(
                 'Error while getting frame: %s' % xdll.error2str(error))
         # frame_buffer = np.reshape(frame_buffer, frame_dims)
         return error == xdll.XDLL.I_OK  # , frame_buffer
 
 
-    def set_handler(self, handler, incl_ctrl_frames=False):
+    def set_handler(self, handler, incl_ctrl_frames=False, policy=None,
+                    maxsize=None):
         '''
-        Adds a new output to which frames are written.
+        Adds a new output to which frames are written. Each handler gets
+        its own queue and delivery thread, see delivery.HandlerQueue.
 
         @param handler: a file-like object, a stream or object with write()
                         and read() methods.
+        @param policy: What to do when the handler's queue is full,
+                       'block', 'drop_newest' or 'drop_oldest'. None uses
+                       the handler's delivery_policy attribute, or 'block'.
+        @param maxsize: Queue length, utils.DELIVERY_QUEUE_SIZE when None
         '''
         self.handlers.append((handler, incl_ctrl_frames))
+        self._handler_options.append({'policy': policy, 'maxsize': maxsize})
 
 
     def clear_handlers(self):
         name = 'clear_handlers'
         if not self.is_alive():
             self.handlers.clear()
+            self._handler_options.clear()
             print(name, 'Cleared handlers')
         else:
             raise Exception('Can\'t clear handlers when thread is alive')
 
 
+    def get_handler_stats(self):
+        '''
+        Delivery counters of each handler in the latest recording: frames
+        delivered and dropped, errors, lag (queued frames) and latency.
+        @return: List of dicts, see delivery.HandlerQueue.stats()
+        '''
+        if self._dispatcher is None:
+            return []
+        return self._dispatcher.stats()
+
+
     def check_thread_exceptions(self):
         name = 'check_thread_exceptions'
         try:
@@ -316,6 +897,7 @@ class XevaCam(object):
         Starts recording frames to handlers.
         '''
         self.enabled = True
+        self._dispatcher = None
         self._capture_thread = threading.Thread(name='capture_thread',
                                                 target=self.capture_frame_stream)
         self._capture_thread.start()
@@ -348,6 +930,9 @@ class XevaCam(object):
         self._capture_thread.join(5)
         if self._capture_thread.is_alive():
             raise Exception('Thread didn\'t stop.')
+        if self._dispatcher is not None:
+            # Let the handlers write what is still queued
+            self._dispatcher.stop()
         end = time.time()
         self._record_time += end-start
         error = xdll.XDLL.stop_capture(self.handle)
@@ -359,19 +944,96 @@ class XevaCam(object):
 
         # Return ENVI metadata about the recording
         frame_dims = self.get_frame_dims()
-        frame_type = self.get_frame_type()
+        pixel_size = self.get_pixel_size()
         meta = (('samples', frame_dims[1]),
                 ('bands', self.frames_count),
                 ('lines', frame_dims[0]),
                 ('data type',
                  utils.datatype2envitype(
-                     'u' + str(xdll.XDLL.pixel_sizes[frame_type]))),
+                     'u' + str(pixel_size))),
                 ('interleave', 'bil'),
                 ('byte order', 1),
-                ('description', 'Capture time = %d\nFrame time stamps = %s' % (self._record_time, str(self._times))))
+                ('description',
+                 'Capture time = %d\nDropped frames = %d\nRepeated frames = %d (%s)\n'
+                 'Frame time stamps = %s' % (
+                    self._record_time, self.stats.dropped,
+                    self.stats.duplicates,
+                    'dropped' if self.drop_duplicates else 'recorded, flagged',
+                    utils.TIMESTAMP_DESCRIPTION)))
         return meta
 
 
+    @property
+    def timestamps(self):
+        '''
+        Frame time stamps of the latest recording.
+        @return: Numpy uint64 array, nanoseconds since recording start
+        '''
+        return self._times[:self._times_count]
+
+
+    @property
+    def fingerprints(self):
+        '''
+        Frame fingerprints of the latest recording, see FrameFingerprinter.
+        @return: Numpy uint64 array
+        '''
+        return self._fingerprints[:self._times_count]
+
+
+    @property
+    def repeated(self):
+        '''
+        Repeated frame flags of the latest recording: True where the
+        fingerprint matches a recent frame, see drop_duplicates.
+        @return: Numpy bool array
+        '''
+        return self._repeated[:self._times_count].view(np.bool_)
+
+
+    def _append_time(self, t, fp=0, repeated=False):
+        '''
+        Stores a frame time stamp, fingerprint and repeated flag, growing
+        the preallocated buffers when full.
+        '''
+        if self._times_count == self._times.shape[0]:
+            for attr in ('_times', '_fingerprints', '_repeated'):
+                old = getattr(self, attr)
+                grown = np.zeros(2 * old.shape[0], dtype=old.dtype)
+                grown[:self._times_count] = old
+                setattr(self, attr, grown)
+        self._times[self._times_count] = t
+        self._fingerprints[self._times_count] = fp
+        self._repeated[self._times_count] = repeated
+        self._times_count += 1
+
+
+    def save_timestamps(self, filepath):
+        '''
+        Writes frame time stamps of the latest recording to a binary sidecar
+        file, see utils.write_timestamps().
+
+        @param filepath: Path of the sidecar file, e.g. '<recording>.ts'
+        '''
+        utils.write_timestamps(self.timestamps, filepath)
+
+
+    def save_fingerprints(self, filepath):
+        '''
+        Writes frame fingerprints of the latest recording to a binary
+        sidecar file of little-endian uint64 values.
+        '''
+        utils.write_timestamps(self.fingerprints, filepath)
+
+
+    def save_repeated(self, filepath):
+        '''
+        Writes the repeated frame flags of the latest recording to a
+        binary sidecar file, one uint8 (0 or 1) per frame.
+        '''
+        self._repeated[:self._times_count].tofile(filepath)
+
+
     def capture_frame_stream(self):
         '''
         Thread function for continuous camera capturing.
@@ -381,6 +1043,7 @@ class XevaCam(object):
         try:
             error = xdll.XDLL.start_capture(self.handle)
             if error != xdll.XDLL.I_OK:
+                self.count_error(error)
                 xdll.print_error(error)
                 raise Exception(
                     '%s Starting capture failed! %s' % (name, xdll.error2str(error)))
@@ -395,43 +1058,77 @@ class XevaCam(object):
                 raise Exception('Camera is not capturing.')
             elif xdll.XDLL.is_capturing(self.handle):
                 self.frames_count = 0
-                size = self.get_frame_size()
-                dims = self.get_frame_dims()
-                frame_t = self.get_frame_type()
+                self._times_count = 0
+                size = self._raw_frame_size()
+                dims = self._raw_frame_dims()
+                frame_t, readout_flag = self.get_readout()
                 # pixel_size = self.get_pixel_size()
                 print(name, 'Size:', size, 'Dims:', dims, 'Frame type:', frame_t)
-                frame_buffer = bytes(size)
-                # ctrl_frame_buffer = bytearray(4)  # 32 bits
-                start_time = utils.get_time()
+                out_size = size
+                if self.roi is not None:
+                    # Read into a scratch buffer, the ROI is copied into
+                    # the published frame right after readout
+                    frame_buffer = bytes(size)
+                    frame_view = np.frombuffer(
+                        frame_buffer, dtype=self._roi_dtype).reshape(dims)
+                    roi_slices = self._roi_slices()
+                    out_size = self.get_frame_size()
+                    scratch = np.frombuffer(frame_buffer, dtype=self.get_pixel_dtype())
+                queues = [HandlerQueue(h, incl_ctrl_frame,
+                                       exc_queue=self.exc_queue, **options)
+                          for (h, incl_ctrl_frame), options
+                          in zip(self.handlers, self._handler_options)]
+                self._dispatcher = FrameDispatcher(out_size, queues)
+                self._dispatcher.start()
+                pool = self._dispatcher.pool
+                pixel_dtype = self.get_pixel_dtype()
+                self.stats.reset()
+                self.fingerprinter.reset()
+                frame = pool.get()
+                backoff = utils.POLL_BACKOFF_MIN
+                start_time = utils.get_time_ns()
+                self.record_start_ns = start_time
                 while self._enabled:
-                    # frame_buffer = \
-                    #     np.zeros((size / pixel_size,),
-                    #              dtype=np.int16)
-                    # buffer = memoryview(frame_buffer)
-                    while True:
-                        ok = self.get_frame(frame_buffer,
-                                            frame_t=frame_t,
-                                            size=size,
-                                            flag=0)  # Non-blocking
-                        # xdll.XGF_Blocking
-                        if ok:
-                            curr_time = utils.get_time() - start_time
-                            self._times.append(curr_time)
-                            ctrl_frame_buffer = struct.pack('I', curr_time)  # 4 bytes
-                            for h, incl_ctrl_frame in self.handlers:
-                                # print(name,
-                                #       'Writing to %s' % str(h.__class__.__name__))
-                                if incl_ctrl_frame:
-                                    h.write(ctrl_frame_buffer)
-                                wrote_bytes = h.write(frame_buffer)
-                                # print(name,
-                                #       'Wrote to %s:' % str(h.__class__.__name__),
-                                #       wrote_bytes,
-                                #       'bytes')
-                            break
-                        # else:
-                        #     print(name, 'Missed frame', i)
+                    # Without ROI the DLL writes straight into the frame
+                    # that is published to the handlers
+                    ok = self.get_frame(frame.address if self.roi is None
+                                        else frame_buffer,
+                                        frame_t=frame_t,
+                                        size=size,
+                                        flag=readout_flag)  # Non-blocking
+                    if not ok:
+                        # No frame yet, back off instead of spinning
+                        time.sleep(backoff)
+                        backoff = min(2 * backoff,
+                                      self.stats.max_backoff())
+                        continue
+                    backoff = utils.POLL_BACKOFF_MIN
+                    now = utils.get_time_ns()
+                    curr_time = now - start_time
+                    if self.roi is None:
+                        pixels = np.frombuffer(frame.array, dtype=pixel_dtype)
+                    else:
+                        pixels = scratch
+                    fp = self.fingerprinter.fingerprint(pixels)
+                    repeated = self.fingerprinter.check(fp)
+                    if repeated:
+                        self.stats.duplicates += 1
+                        if self.drop_duplicates:
+                            # Opt-in, a static scene repeats as well
+                            continue
+                    self._append_time(curr_time, fp, repeated)
+                    self.stats.update(curr_time)
+                    if self.roi is not None:
+                        np.copyto(frame.array.view(self._roi_dtype).reshape(
+                            self.roi[2:]), frame_view[roi_slices])
+                    frame.time = now
+                    frame.ctrl = struct.pack('<Q', curr_time)  # 8 bytes
+                    # Handlers share the buffer, it returns to the pool
+                    # when the last one has written it
+                    self._dispatcher.publish(frame)
+                    frame = pool.get()
                     self.frames_count += 1
+                pool.put(frame)
             else:
                 raise Exception('Camera is not capturing.')
         except Exception as e:
@@ -465,9 +1162,9 @@ class XevaCam(object):
             raise Exception('Camera is not capturing.')
 
         elif xdll.XDLL.is_capturing(self.handle):
-            size = self.get_frame_size()
-            dims = self.get_frame_dims()
-            frame_t = self.get_frame_type()
+            size = self._raw_frame_size()
+            dims = self._raw_frame_dims()
+            frame_t, readout_flag = self.get_readout()
             frame_buffer = bytes(size)
 
             if dump_buffer:
@@ -475,7 +1172,7 @@ class XevaCam(object):
                     frame_buffer,
                     frame_t = frame_t,
                     size = size,
-                    flag = xdll.XDLL.XGF_Blocking
+                    flag = xdll.XDLL.XGF_Blocking | readout_flag
                 )
                 frame_buffer = bytes(size)
 
@@ -483,7 +1180,7 @@ class XevaCam(object):
                 frame_buffer,
                 frame_t = frame_t,
                 size = size,
-                flag = xdll.XDLL.XGF_Blocking
+                flag = xdll.XDLL.XGF_Blocking | readout_flag
             )
 
         else:
@@ -0,0 +1,241 @@
+'''
+Frame delivery from the capture thread to the handlers.
+
+The capture thread reads each frame into a buffer taken from a FramePool
+and publishes it once. Every handler has its own bounded queue and
+delivery thread, so a slow handler (a file on a busy disk, a preview)
+only fills its own queue instead of delaying XC_GetFrame. The buffer is
+shared by all queues; a reference count returns it to the pool when the
+last handler is done, so frames are not copied per handler.
+
+What happens when a queue is full is chosen per handler:
+    'block'        The capture thread waits, no frame is lost
+    'drop_newest'  The new frame is skipped for this handler
+    'drop_oldest'  The oldest queued frame is discarded, e.g. previews
+
+Handlers receive a memoryview that is only valid during write(). Handlers
+that keep the buffer (XevaStream queues it, PreviewStream holds the last
+one) set the attribute retains_frames = True and get a private copy,
+made on their delivery thread. A handler may also set delivery_policy.
+'''
+
+import queue
+import sys
+import threading
+import numpy as np
+
+import laserscan.xevacam.utils as utils
+
+POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+
+class SharedFrame(object):
+    '''
+    Reference counted frame buffer from a FramePool.
+    '''
+
+    def __init__(self, pool, nbytes):
+        self._pool = pool
+        self.array = np.empty(nbytes, dtype=np.uint8)
+        self.address = self.array.ctypes.data  # For XC_GetFrame
+        self.data = memoryview(self.array)
+        self.time = 0  # ns, see utils.get_time_ns()
+        self.ctrl = b''  # Control frame written before the frame
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    def retain(self, n=1):
+        with self._lock:
+            self._refs += n
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            free = self._refs <= 0
+        if free:
+            self._pool.put(self)
+
+
+class FramePool(object):
+    '''
+    Free list of equally sized SharedFrame buffers. Grows on demand; the
+    bounded handler queues limit how many frames are in flight.
+    '''
+
+    def __init__(self, nbytes, count=4):
+        self.nbytes = nbytes
+        self.allocated = 0
+        self._free = []
+        self._lock = threading.Lock()
+        for i in range(count):
+            self._free.append(self._new())
+
+    def _new(self):
+        self.allocated += 1
+        return SharedFrame(self, self.nbytes)
+
+    def get(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            return self._new()
+
+    def put(self, frame):
+        with self._lock:
+            self._free.append(frame)
+
+
+class HandlerQueue(object):
+    '''
+    Bounded queue and delivery thread of one handler.
+    '''
+
+    def __init__(self, handler, incl_ctrl_frames=False, maxsize=None,
+                 policy=None, copy=None, exc_queue=None):
+        '''
+        @param handler: Object with write()
+        @param incl_ctrl_frames: Write the 8 byte time stamp before frames
+        @param maxsize: Queue length, utils.DELIVERY_QUEUE_SIZE when None
+        @param policy: One of POLICIES, the handler's delivery_policy
+                       attribute or 'block' when None
+        @param copy: Give the handler a private copy of each frame, the
+                     handler's retains_frames attribute when None
+        @param exc_queue: Queue for sys.exc_info() of handler errors
+        '''
+        if policy is None:
+            policy = getattr(handler, 'delivery_policy', 'block')
+        if policy not in POLICIES:
+            raise Exception('Unknown delivery policy %s' % str(policy))
+        self.handler = handler
+        self.incl_ctrl_frames = incl_ctrl_frames
+        self.policy = policy
+        self.copy = getattr(handler, 'retains_frames', False) if copy is None else copy
+        self.exc_queue = exc_queue
+        self.name = type(handler).__name__
+        self._queue = queue.Queue(maxsize or utils.DELIVERY_QUEUE_SIZE)
+        self._thread = None
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency_max = 0  # ns from publish to written
+        self._latency_sum = 0
+
+    def start(self):
+        self._thread = threading.Thread(name='delivery_' + self.name,
+                                        target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, frame):
+        '''
+        Queues a frame, which must already be retained for this queue.
+        '''
+        if self.policy == 'block':
+            self._queue.put(frame)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(frame)
+                return
+            except queue.Full:
+                pass
+            if self.policy == 'drop_newest':
+                self.dropped += 1
+                frame.release()
+                return
+            try:
+                old = self._queue.get_nowait()
+            except queue.Empty:
+                continue  # Emptied meanwhile, try again
+            self.dropped += 1
+            old.release()
+
+    def stop(self):
+        '''
+        Writes the queued frames and ends the delivery thread.
+        '''
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def lag(self):
+        '''
+        Frames waiting in the queue.
+        '''
+        return self._queue.qsize()
+
+    def _run(self):
+        name = 'delivery'
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            try:
+                data = bytes(frame.data) if self.copy else frame.data
+                if self.incl_ctrl_frames:
+                    self.handler.write(frame.ctrl)
+                self.handler.write(data)
+                latency = utils.get_time_ns() - frame.time
+                self.latency_max = max(self.latency_max, latency)
+                self._latency_sum += latency
+                self.delivered += 1
+            except Exception as e:
+                self.errors += 1
+                print(name, '%s: %s' % (self.name, str(e)))
+                if self.exc_queue is not None:
+                    self.exc_queue.put(sys.exc_info())
+            finally:
+                frame.release()
+
+    def stats(self):
+        '''
+        @return: dict with delivered and dropped frames, errors, the
+                 current lag in frames and the latency in seconds
+        '''
+        avg = self._latency_sum / self.delivered if self.delivered else 0
+        return {'handler': self.name,
+                'policy': self.policy,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'lag': self.lag(),
+                'latency_avg': avg * 1e-9,
+                'latency_max': self.latency_max * 1e-9}
+
+
+class FrameDispatcher(object):
+    '''
+    Fans frames out to HandlerQueues.
+    '''
+
+    def __init__(self, nbytes, queues):
+        '''
+        @param nbytes: Size of the published frames
+        @param queues: HandlerQueue list
+        '''
+        self.pool = FramePool(nbytes)
+        self.queues = queues
+
+    def start(self):
+        for q in self.queues:
+            q.start()
+
+    def publish(self, frame):
+        '''
+        Hands a frame from self.pool to every queue. The caller gives up
+        its reference.
+        '''
+        if not self.queues:
+            self.pool.put(frame)
+            return
+        frame.retain(len(self.queues))
+        for q in self.queues:
+            q.put(frame)
+
+    def stop(self):
+        for q in self.queues:
+            q.stop()
+
+    def stats(self):
+        return [q.stats() for q in self.queues]
@@ -0,0 +1,59 @@
+'''
+Frame fingerprints for detecting stale or repeated frames.
+
+XC_GetFrame can hand back the same frame twice after property changes or
+buffer underruns. Sensor noise makes every real frame differ, so a frame
+whose fingerprint matches a recent one is a repeat. The fingerprint is
+the CRC32 of a sparse pixel sample in the high 32 bits and the low bits
+of the frame sum in the low 32 bits; it costs one vectorized sum and a
+few thousand pixel reads per frame.
+'''
+
+import collections
+import zlib
+import numpy as np
+
+
+class FrameFingerprinter(object):
+
+    def __init__(self, history=4, samples=4096):
+        '''
+        @param history: Number of recent fingerprints compared against
+        @param samples: Pixels in the sparse sample
+        '''
+        self.samples = samples
+        self._history = collections.deque(maxlen=history)
+        self._stride = {}  # Sample stride by frame length
+        self.duplicates = 0
+
+    def reset(self):
+        self._history.clear()
+        self.duplicates = 0
+
+    def fingerprint(self, frame):
+        '''
+        @param frame: ndarray of the frame pixels, any shape
+        @return: int, 64 bit fingerprint
+        '''
+        flat = frame.reshape(-1)
+        n = flat.shape[0]
+        stride = self._stride.get(n)
+        if stride is None:
+            # Odd stride, so the sample does not stay in a few columns
+            stride = max(1, n // self.samples) | 1
+            self._stride[n] = stride
+        crc = zlib.crc32(flat[::stride].tobytes())
+        total = int(flat.sum(dtype=np.uint64)) & 0xffffffff
+        return (crc << 32) | total
+
+    def check(self, fp):
+        '''
+        Compares a fingerprint with the history and adds it.
+        @return: True if the frame repeats a recent one
+        '''
+        duplicate = fp in self._history
+        if duplicate:
+            self.duplicates += 1
+        else:
+            self._history.append(fp)
+        return duplicate
@@ -0,0 +1,252 @@
+'''
+Shared memory frame bus for analysis processes.
+
+The capture process publishes frames into a ring of slots in one
+multiprocessing.shared_memory block; any number of local processes attach
+by name and read the frames as ndarray views, without pickling or
+copying. Fitting, compression or rendering then run in their own
+processes, outside the GIL of the acquisition.
+
+Every published frame gets a sequence number. The writer never waits for
+readers: frame n goes to slot n % slots and overwrites whatever was
+there. Slots work like a seqlock, the writer marks a slot as being
+written (-1) before copying and stores the sequence number after, so a
+reader checks that the slot still holds its frame after using the view
+(valid()) and drops frames that were overwritten meanwhile. A reader that
+falls a whole ring behind skips ahead to the middle of the ring; skipped
+frames are counted in `lapped`.
+
+Writer, a handler for XevaCam.set_handler():
+    bus = FrameBus(cam.get_frame_dims(), cam.get_pixel_dtype(), slots=32)
+    cam.set_handler(bus, policy='drop_oldest')
+    ... bus.name is passed to the workers ...
+    bus.close()
+
+Reader, in another process:
+    reader = FrameBusReader(name)
+    for seq, t, frame in reader.frames():
+        result = analyse(frame)
+        if reader.valid(seq):
+            keep(result)
+'''
+
+import multiprocessing
+import sys
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+import laserscan.xevacam.utils as utils
+
+MAGIC = 0x58465242  # 'XFRB'
+VERSION = 1
+_HEADER = 8  # int64: magic, version, slots, height, width, frame bytes, head, -
+_DTYPE_BYTES = 16
+_ALIGN = 64
+_WRITING = -1
+_created = set()  # Blocks created by this process
+
+
+def _layout(slots, nbytes):
+    # Byte offsets of the slot tables and of the first frame
+    seq_offset = _HEADER * 8 + _DTYPE_BYTES
+    time_offset = seq_offset + 8 * slots
+    data_offset = -(-(time_offset + 8 * slots) // _ALIGN) * _ALIGN
+    stride = -(-nbytes // _ALIGN) * _ALIGN
+    return seq_offset, time_offset, data_offset, stride
+
+
+class _Ring(object):
+    # Views of the shared block shared by the writer and the readers
+
+    def _map(self, shm):
+        self._shm = shm
+        buf = shm.buf
+        self.header = np.ndarray((_HEADER,), dtype=np.int64, buffer=buf)
+        magic, version, slots, height, width, nbytes = self.header[:6]
+        if magic != MAGIC or version != VERSION:
+            raise Exception('%s is not a frame bus' % shm.name)
+        self.slots = int(slots)
+        self.dims = (int(height), int(width))
+        raw = bytes(buf[_HEADER * 8:_HEADER * 8 + _DTYPE_BYTES])
+        self.dtype = np.dtype(raw.rstrip(b'\0').decode('ascii'))
+        seq_offset, time_offset, data_offset, stride = _layout(self.slots, int(nbytes))
+        self.slot_seq = np.ndarray((self.slots,), dtype=np.int64, buffer=buf,
+                                   offset=seq_offset)
+        self.slot_time = np.ndarray((self.slots,), dtype=np.int64, buffer=buf,
+                                    offset=time_offset)
+        self.frames_view = [
+            np.ndarray(self.dims, dtype=self.dtype, buffer=buf,
+                       offset=data_offset + i * stride)
+            for i in range(self.slots)]
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def head(self):
+        '''
+        @return: Sequence number of the latest published frame, 0 if none
+        '''
+        return int(self.header[6])
+
+    def _release(self):
+        # Views must go before the block can be closed
+        self.header = self.slot_seq = self.slot_time = None
+        self.frames_view = []
+        self._shm.close()
+
+
+class FrameBus(_Ring):
+    '''
+    Writer side of the bus.
+    '''
+
+    def __init__(self, dims, dtype, slots=16, name=None):
+        '''
+        @param dims: Frame dimensions (height, width)
+        @param dtype: Pixel dtype
+        @param slots: Frames kept in the ring, how far readers may lag
+        @param name: Shared memory name, generated when None
+        '''
+        dtype = np.dtype(dtype)
+        height, width = (int(d) for d in dims)
+        nbytes = height * width * dtype.itemsize
+        _, _, data_offset, stride = _layout(slots, nbytes)
+        shm = shared_memory.SharedMemory(name=name, create=True,
+                                         size=data_offset + slots * stride)
+        header = np.ndarray((_HEADER,), dtype=np.int64, buffer=shm.buf)
+        header[:] = (MAGIC, VERSION, slots, height, width, nbytes, 0, 0)
+        del header
+        shm.buf[_HEADER * 8:_HEADER * 8 + _DTYPE_BYTES] = \
+            dtype.str.encode('ascii').ljust(_DTYPE_BYTES, b'\0')
+        _created.add(shm._name)
+        self._map(shm)
+        self.frame_bytes = nbytes
+        self.published = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        '''
+        Handler interface: publishes a raw frame buffer. Buffers of
+        another size (control frames) are ignored.
+        '''
+        if len(b) == self.frame_bytes:
+            self.publish(np.frombuffer(b, dtype=self.dtype).reshape(self.dims))
+        return len(b)
+
+    def publish(self, frame, t=None):
+        '''
+        Copies a frame into the next slot.
+        @param t: Time stamp in ns, utils.get_time_ns() when None
+        @return: Sequence number of the frame
+        '''
+        seq = self.head() + 1
+        slot = seq % self.slots
+        self.slot_seq[slot] = _WRITING
+        np.copyto(self.frames_view[slot], frame, casting='unsafe')
+        self.slot_time[slot] = utils.get_time_ns() if t is None else t
+        self.slot_seq[slot] = seq
+        self.header[6] = seq
+        self.published += 1
+        return seq
+
+    def close(self, unlink=True):
+        '''
+        @param unlink: Remove the block, readers keep their mapping until
+                       they close
+        '''
+        shm = self._shm
+        self._release()
+        if unlink:
+            shm.unlink()
+            _created.discard(shm._name)
+
+
+class FrameBusReader(_Ring):
+    '''
+    Reader side of the bus, for any local process.
+    '''
+
+    def __init__(self, name):
+        '''
+        @param name: FrameBus.name
+        '''
+        shm = shared_memory.SharedMemory(name=name)
+        if sys.version_info < (3, 13) and shm._name not in _created and \
+                multiprocessing.parent_process() is None:
+            # An unrelated process would register the block with its own
+            # resource tracker, which unlinks it when the reader exits.
+            # The writer and its children share one tracker and must not.
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        self._map(shm)
+        self.lapped = 0  # Frames overwritten before they were read
+
+    def valid(self, seq):
+        '''
+        @return: True if the slot still holds frame seq, i.e. a view or
+                 result of frame seq is consistent
+        '''
+        return int(self.slot_seq[seq % self.slots]) == seq
+
+    def read(self, seq, copy=False):
+        '''
+        @param seq: Sequence number
+        @param copy: Return a private copy instead of the shared view
+        @return: (time in ns, ndarray), or None if the frame is not in
+                 the ring (not yet published or overwritten)
+        '''
+        slot = seq % self.slots
+        if int(self.slot_seq[slot]) != seq:
+            return None
+        t = int(self.slot_time[slot])
+        frame = self.frames_view[slot]
+        if copy:
+            frame = frame.copy()
+            if not self.valid(seq):
+                return None  # Overwritten during the copy
+        return t, frame
+
+    def wait(self, seq, timeout=None, poll=utils.POLL_BACKOFF_MAX):
+        '''
+        Waits until frame seq is published.
+        @return: True if published, False on timeout
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.head() < seq:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def frames(self, start=None, copy=False, timeout=None):
+        '''
+        Iterates over published frames in order, waiting for new ones.
+
+        @param start: First sequence number, the next frame when None
+        @param copy: Yield private copies instead of shared views
+        @param timeout: Stop when no frame arrives for this many seconds
+        @return: Generator of (seq, time in ns, ndarray)
+        '''
+        seq = self.head() + 1 if start is None else start
+        while True:
+            if not self.wait(seq, timeout):
+                return
+            head = self.head()
+            if seq <= head - self.slots:
+                # Fell behind the writer. Skip to the middle of the ring,
+                # the oldest frames are about to be overwritten.
+                skip_to = head - self.slots // 2
+                self.lapped += skip_to - seq
+                seq = skip_to
+            item = self.read(seq, copy)
+            if item is None:
+                self.lapped += 1
+            else:
+                yield (seq,) + item
+            seq += 1
+
+    def close(self):
+        self._release()
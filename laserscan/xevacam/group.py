@@ -0,0 +1,192 @@
+'''
+Synchronized acquisition from several cameras.
+
+A CameraGroup holds named XevaCam instances, the first one being the
+primary camera of the scan, e.g. the signal arm, and the others
+references. capture() reads one frame from every camera at the same time,
+each on its own thread (the DLL calls release the GIL), so a scan with a
+reference camera takes about as long as with one camera. The reference
+frames are written to one framestore.FrameStore per camera, keyed like
+the primary frames (by wavelength), and the time skew between the
+cameras is recorded for every capture.
+
+Recordings started with start_recording() run the capture thread of each
+camera; match_recordings() pairs their frames by time stamp afterwards.
+
+Example:
+    group = CameraGroup([('signal', cam), ('reference', XevaCam())],
+                        output_dir)
+    group.open({'signal': 'cam://0', 'reference': 'cam://1'})
+    frames = group.capture(key=1530.0)
+    print(group.skew_stats())
+    group.close()
+'''
+
+import concurrent.futures
+import csv
+import os
+import numpy as np
+
+import laserscan.xevacam.utils as utils
+from laserscan.framestore import FrameStore
+
+
+class CameraGroup(object):
+
+    def __init__(self, cams, output_dir=None, store_primary=False,
+                 store_kwargs=None):
+        '''
+        @param cams: List of (name, XevaCam), the first is the primary
+        @param output_dir: Directory of the per-camera stores
+                           'frames_<name>' and camera_skew.csv, nothing is
+                           written when None
+        @param store_primary: Also store the primary frames, normally
+                              saved by capture_and_save_image()
+        @param store_kwargs: Extra FrameStore arguments, e.g. codec
+        '''
+        if not cams:
+            raise Exception('Camera group is empty.')
+        self.names = [name for name, _ in cams]
+        self.cams = dict(cams)
+        self.primary = self.names[0]
+        self.output_dir = output_dir
+        self.store_primary = store_primary
+        self.store_kwargs = store_kwargs or {}
+        self.stores = {}
+        self.skews = []  # (key, skew in ns) of each capture
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(cams), thread_name_prefix='camera_group')
+
+    def _map(self, func):
+        # Runs func(name, cam) for every camera in parallel
+        futures = {name: self._pool.submit(func, name, self.cams[name])
+                   for name in self.names}
+        return {name: f.result() for name, f in futures.items()}
+
+    def open(self, camera_paths, sw_correction=True):
+        '''
+        Opens all cameras in parallel.
+        @param camera_paths: dict name -> camera URL, e.g. 'cam://1'
+        '''
+        self._map(lambda name, cam: cam.open(camera_paths[name], sw_correction))
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+        for name in self.names:
+            self.cams[name].close()
+        self._pool.shutdown()
+
+    def capture(self, key=None, flush=0):
+        '''
+        Captures one frame from every camera at the same time.
+
+        @param key: Key of the frames in the stores, e.g. the wavelength
+        @param flush: Frames read and discarded first, e.g. after a
+                      property change
+        @return: dict name -> (buffer, size, dims, time in ns)
+        '''
+        def read(name, cam):
+            for _ in range(flush):
+                cam.capture_frame_only()
+            buffer, size, dims = cam.capture_frame_only()
+            return buffer, size, dims, utils.get_time_ns()
+
+        frames = self._map(read)
+        times = [f[3] for f in frames.values()]
+        skew = max(times) - min(times)
+        self.skews.append((key, skew))
+        if self.output_dir is not None:
+            self._store(frames, key)
+            self._log_skew(key, skew)
+        return frames
+
+    def _store(self, frames, key):
+        for name, (buffer, size, dims, _) in frames.items():
+            if name == self.primary and not self.store_primary:
+                continue
+            store = self.stores.get(name)
+            if store is None:
+                store = FrameStore(
+                    os.path.join(self.output_dir, 'frames_%s' % name), dims,
+                    self.cams[name].get_pixel_dtype(), **self.store_kwargs)
+                self.stores[name] = store
+            frame = np.frombuffer(buffer, dtype=store.dtype).reshape(dims)
+            store.write_frame(frame, key=key)
+
+    def _log_skew(self, key, skew):
+        path = os.path.join(self.output_dir, 'camera_skew.csv')
+        new = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(('key', 'skew_ms'))
+            writer.writerow((key, '%.3f' % (skew * 1e-6)))
+
+    def skew_stats(self):
+        '''
+        @return: dict with the mean and max skew (ms) between the frames
+                 of a capture, and the number of captures
+        '''
+        if not self.skews:
+            return {'captures': 0, 'mean_ms': 0.0, 'max_ms': 0.0}
+        skews = np.array([s for _, s in self.skews], dtype=np.float64) * 1e-6
+        return {'captures': len(skews),
+                'mean_ms': float(skews.mean()),
+                'max_ms': float(skews.max())}
+
+    def set_handler(self, name, handler, incl_ctrl_frames=False, **kwargs):
+        '''
+        Adds a handler to one camera's recordings.
+        '''
+        self.cams[name].set_handler(handler, incl_ctrl_frames, **kwargs)
+
+    def start_recording(self):
+        for name in self.names:
+            self.cams[name].start_recording()
+
+    def stop_recording(self):
+        '''
+        @return: dict name -> ENVI metadata of XevaCam.stop_recording()
+        '''
+        return {name: self.cams[name].stop_recording() for name in self.names}
+
+    def match_recordings(self, tolerance_ms=None):
+        '''
+        Pairs each frame of the primary camera's latest recording with the
+        nearest frame in time of every other camera.
+
+        @param tolerance_ms: Matches further apart become -1, half the
+                             primary frame interval when None
+        @return: (indices, skews), dicts name -> int array of frame
+                 numbers and name -> float array of signed skews in ms,
+                 one entry per primary frame
+        '''
+        ref = self.cams[self.primary]
+        t0 = ref.timestamps.astype(np.int64) + ref.record_start_ns
+        if tolerance_ms is None:
+            interval = np.median(np.diff(t0)) if t0.shape[0] > 1 else 0
+            tolerance = interval / 2
+        else:
+            tolerance = tolerance_ms * 1e6
+        indices, skews = {}, {}
+        for name in self.names[1:]:
+            cam = self.cams[name]
+            t = cam.timestamps.astype(np.int64) + cam.record_start_ns
+            if t.shape[0] == 0:
+                indices[name] = np.full(t0.shape, -1)
+                skews[name] = np.full(t0.shape, np.nan)
+                continue
+            # Nearest neighbour in the sorted time stamps
+            right = np.clip(np.searchsorted(t, t0), 1, t.shape[0] - 1)
+            left = right - 1
+            if t.shape[0] == 1:
+                left = right = np.zeros_like(t0)
+            nearest = np.where(np.abs(t[left] - t0) <= np.abs(t[right] - t0),
+                               left, right)
+            skew = (t[nearest] - t0).astype(np.float64)
+            far = np.abs(skew) > tolerance
+            indices[name] = np.where(far, -1, nearest)
+            skews[name] = np.where(far, np.nan, skew * 1e-6)
+        return indices, skews
@@ -0,0 +1,300 @@
+'''
+Local frame streaming server.
+
+The process that owns the camera serves live frames to other tools on
+the same machine (notebooks, an alignment UI), which then do not need
+the camera handle. FrameServer is a handler for XevaCam.set_handler();
+clients connect over localhost TCP, or a Unix domain socket where the
+platform has one.
+
+Protocol. After connecting, a client sends one JSON line with its
+subscription, e.g. {"decimation": 5, "roi": [100, 200, 64, 64]}; both
+keys are optional. The server then sends frames, each a binary header
+followed by the raw pixels in C order:
+
+    HEADER: magic b'XFRM', version (uint16), reserved (uint16),
+            sequence (uint64), time stamp in ns (int64),
+            height (uint32), width (uint32), numpy dtype str (8 bytes)
+
+all little-endian. The header and the pixels go out in one sendmsg()
+call from a memoryview of the frame, so the pixels are not copied into a
+message buffer (on Windows, without sendmsg, two sendall() calls).
+
+Every client has its own send thread and a bounded buffer of frames
+waiting to be sent. When a client cannot keep up, its oldest frames are
+dropped and counted, so a slow client never blocks the camera or the
+other clients.
+
+Example:
+    server = FrameServer(cam.get_frame_dims(), cam.get_pixel_dtype())
+    cam.set_handler(server, policy='drop_oldest')
+    server.start()
+    ...
+    server.stop()
+
+    client = FrameClient(server.address, decimation=10)
+    seq, t, frame = client.recv()
+'''
+
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import numpy as np
+
+import laserscan.xevacam.utils as utils
+
+MAGIC = b'XFRM'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQqII8s')
+
+
+def pack_header(seq, t, frame):
+    return HEADER.pack(MAGIC, VERSION, 0, seq, t, frame.shape[0],
+                       frame.shape[1], frame.dtype.str.encode('ascii'))
+
+
+def _send(conn, parts):
+    # One sendmsg() of all parts, continued where a partial send stopped
+    parts = [memoryview(p).cast('B') for p in parts]
+    if not hasattr(conn, 'sendmsg'):
+        for p in parts:
+            conn.sendall(p)
+        return
+    while parts:
+        n = conn.sendmsg(parts)
+        while parts and n >= len(parts[0]):
+            n -= len(parts[0])
+            parts.pop(0)
+        if parts:
+            parts[0] = parts[0][n:]
+
+
+class _Client(object):
+    # One connected client: subscription, send buffer and send thread
+
+    def __init__(self, server, conn, addr, buffer_size):
+        self.server = server
+        self.conn = conn
+        self.addr = addr
+        self.decimation = 1
+        self.roi = None
+        self._queue = collections.deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._open = True
+        self.sent = 0
+        self.dropped = 0
+        self.thread = threading.Thread(name='frame_client', target=self._run,
+                                       daemon=True)
+
+    def subscribe(self):
+        # Reads the JSON subscription line
+        f = self.conn.makefile('rb')
+        line = f.readline(4096)
+        f.close()
+        request = json.loads(line.decode('utf-8')) if line.strip() else {}
+        self.decimation = max(1, int(request.get('decimation', 1)))
+        roi = request.get('roi')
+        if roi is not None:
+            row, col, height, width = (int(v) for v in roi)
+            self.roi = (slice(row, row + height), slice(col, col + width))
+
+    def offer(self, seq, t, frame):
+        if seq % self.decimation:
+            return
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1  # deque drops the oldest
+            self._queue.append((seq, t, frame))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._open = False
+            self._cond.notify()
+
+    def _run(self):
+        name = 'FrameServer'
+        try:
+            self.subscribe()
+            while True:
+                with self._cond:
+                    while self._open and not self._queue:
+                        self._cond.wait()
+                    if not self._open:
+                        break
+                    seq, t, frame = self._queue.popleft()
+                if self.roi is not None:
+                    frame = np.ascontiguousarray(frame[self.roi])
+                _send(self.conn, (pack_header(seq, t, frame), frame))
+                self.sent += 1
+        except (OSError, ValueError) as e:
+            print(name, 'Client %s disconnected: %s' % (str(self.addr), str(e)))
+        finally:
+            self._open = False
+            self.conn.close()
+            self.server._remove(self)
+
+    def stats(self):
+        return {'client': str(self.addr),
+                'decimation': self.decimation,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'buffered': len(self._queue)}
+
+
+class FrameServer(object):
+    '''
+    Serves the frames written to it to connected clients.
+    '''
+
+    retains_frames = True  # Frames are queued for the clients
+
+    def __init__(self, dims, dtype, address=('127.0.0.1', 0), buffer_size=4):
+        '''
+        @param dims: Frame dimensions (height, width)
+        @param dtype: Pixel dtype
+        @param address: (host, port) for TCP, port 0 picks a free port, or
+                        a file path for a Unix domain socket. Only bind
+                        to localhost, there is no authentication.
+        @param buffer_size: Frames buffered per client before dropping
+        '''
+        self.dims = tuple(int(d) for d in dims)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(self.dims)) * self.dtype.itemsize
+        self.buffer_size = buffer_size
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(address)
+        self.address = self._sock.getsockname()
+        self._clients = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self.seq = 0
+
+    def start(self):
+        self._sock.listen()
+        self._thread = threading.Thread(name='frame_server', target=self._accept,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        try:
+            self._sock.close()
+        finally:
+            with self._lock:
+                clients = list(self._clients)
+            for c in clients:
+                c.close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.unlink(self.address)
+
+    def _accept(self):
+        name = 'FrameServer'
+        while True:
+            try:
+                conn, addr = self._sock.accept()
+            except OSError:
+                break  # Closed by stop()
+            if conn.family != getattr(socket, 'AF_UNIX', None):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(self, conn, addr or self.address, self.buffer_size)
+            with self._lock:
+                self._clients.append(client)
+            client.thread.start()
+            print(name, 'Client %s connected' % str(client.addr))
+
+    def _remove(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        '''
+        Handler interface: serves a raw frame buffer. Buffers of another
+        size (control frames) are ignored.
+        '''
+        if len(b) == self.frame_bytes:
+            frame = np.frombuffer(b, dtype=self.dtype).reshape(self.dims)
+            self.publish(frame)
+        return len(b)
+
+    def publish(self, frame, t=None):
+        '''
+        Offers a frame to every client. The frame must not be modified
+        afterwards, clients send it later.
+        '''
+        self.seq += 1
+        t = utils.get_time_ns() if t is None else t
+        with self._lock:
+            clients = list(self._clients)
+        for c in clients:
+            c.offer(self.seq, t, frame)
+
+    def stats(self):
+        '''
+        @return: List of dicts per client: frames sent, dropped, buffered
+        '''
+        with self._lock:
+            return [c.stats() for c in self._clients]
+
+
+class FrameClient(object):
+    '''
+    Receives frames from a FrameServer.
+    '''
+
+    def __init__(self, address, decimation=1, roi=None, timeout=None):
+        '''
+        @param address: FrameServer.address
+        @param decimation: Receive every n-th frame
+        @param roi: (row, col, height, width) cropped by the server
+        '''
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(address)
+        request = {'decimation': decimation}
+        if roi is not None:
+            request['roi'] = list(roi)
+        self._sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        self._header = bytearray(HEADER.size)
+        self._buffer = None
+
+    def _recv_into(self, view):
+        while len(view):
+            n = self._sock.recv_into(view)
+            if n == 0:
+                raise Exception('Frame server closed the connection')
+            view = view[n:]
+
+    def recv(self, copy=True):
+        '''
+        @param copy: Return a new array. Otherwise the array is a view of
+                     a buffer reused by the next recv()
+        @return: (sequence, time in ns, ndarray)
+        '''
+        self._recv_into(memoryview(self._header))
+        magic, version, _, seq, t, height, width, dtype = HEADER.unpack(self._header)
+        if magic != MAGIC or version != VERSION:
+            raise Exception('Not a frame stream')
+        dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        nbytes = height * width * dtype.itemsize
+        if self._buffer is None or len(self._buffer) != nbytes:
+            self._buffer = bytearray(nbytes)
+        self._recv_into(memoryview(self._buffer))
+        frame = np.frombuffer(self._buffer, dtype=dtype).reshape(height, width)
+        return seq, t, frame.copy() if copy else frame
+
+    def close(self):
+        self._sock.close()
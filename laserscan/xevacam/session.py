@@ -0,0 +1,92 @@
+'''
+Warm camera session with automatic reconnect.
+
+The session opens the camera once and keeps the handle across scans.
+Camera calls made through the session that fail because the handle is
+gone (E_INVALID_HANDLE, E_NOINIT, or the camera no longer initialised)
+reconnect with XevaCam.reconnect() and are retried once, so a transient
+fault (cable, power glitch) costs seconds instead of an application
+restart. The calibration is loaded again only when the new handle needs
+it, or when its file has changed.
+
+The session forwards every other attribute to the camera, so it can be
+passed wherever an XevaCam is expected:
+
+    cam = CameraSession(XevaCam(calibration=xca), 'cam://0')
+    with cam:
+        app = LaserScanApp(laser, cam, output_dir)
+        app.run()
+'''
+
+import time
+
+# Camera methods retried after a reconnect
+RECOVERABLE = ('capture_frame_only', 'capture_single_frame', 'set_property',
+               'set_properties', 'get_property_info', 'snapshot_properties',
+               'save_properties', 'get_frame_parameters')
+
+
+class CameraSession(object):
+
+    def __init__(self, cam, camera_path='cam://0', sw_correction=True,
+                 retries=5, delay=1.0):
+        '''
+        @param cam: XevaCam
+        @param camera_path: Camera URL given to XevaCam.open()
+        @param sw_correction: Start the software correction filter
+        @param retries: Attempts to reopen the camera after a fault
+        @param delay: Seconds between attempts
+        '''
+        self.cam = cam
+        self.camera_path = camera_path
+        self.sw_correction = sw_correction
+        self.retries = retries
+        self.delay = delay
+        self.recoveries = []  # Seconds taken by each reconnect
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def open(self):
+        '''
+        Opens the camera, or keeps the handle if it is already open.
+        '''
+        self.cam.open(self.camera_path, self.sw_correction)
+
+    def close(self):
+        self.cam.close()
+
+    def recover(self):
+        '''
+        Reconnects the camera.
+        '''
+        start = time.monotonic()
+        self.cam.reconnect(self.retries, self.delay)
+        self.recoveries.append(time.monotonic() - start)
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Calls func, reconnecting and retrying once if the camera handle
+        was lost.
+        '''
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not self.cam.handle_lost(e):
+                raise
+            print('CameraSession', 'Camera handle lost: %s' % str(e))
+        self.recover()
+        return func(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.cam, name)
+        if name in RECOVERABLE:
+            def recoverable(*args, **kwargs):
+                return self.call(attr, *args, **kwargs)
+            return recoverable
+        return attr
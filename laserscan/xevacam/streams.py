@@ -5,14 +5,18 @@ Created on 23.11.2016
 '''
 import io
 import threading
+import numpy as np
 
 
 class XevaStream(io.IOBase):
 
+    retains_frames = True  # Queues the buffers, see delivery.HandlerQueue
+
     def __init__(self):
         super().__init__()
         self.queue_lock = threading.Lock()
         self._queue = []
+        self.bytes_written = 0  # Total, for monitoring
         # self.remaining = bytearray()
         # self.memview = memoryview(self.remaining)
 
@@ -25,6 +29,7 @@ class XevaStream(io.IOBase):
     def write(self, b):
         self.queue_lock.acquire()
         self._queue.append(b)
+        self.bytes_written += len(b)
         self.queue_lock.release()
         return len(b)
 
@@ -37,6 +42,13 @@ class XevaStream(io.IOBase):
         self.queue_lock.release()
         return b
 
+    def backlog(self):
+        '''
+        Number of queued buffers. Does not take the lock, so it is safe
+        to poll from a monitoring thread.
+        '''
+        return len(self._queue)
+
     def is_queue_empty(self):
         self.queue_lock.acquire()
         size = len(self._queue)
@@ -51,6 +63,9 @@ class XevaStream(io.IOBase):
 
 class PreviewStream(io.IOBase):
 
+    retains_frames = True  # Keeps the latest buffer
+    delivery_policy = 'drop_oldest'  # Only the latest frame matters
+
     def __init__(self):
         super().__init__()
         self._lock = threading.Lock()
@@ -72,6 +87,88 @@ class PreviewStream(io.IOBase):
             b = self._current_frame
         return b
 
+
+class StatisticsStream(io.IOBase):
+    '''
+    Per-pixel temporal statistics of the recorded frames.
+
+    Mean and variance are updated in place with Welford's algorithm in
+    float64 accumulators, min and max in the camera dtype. All buffers are
+    allocated once, so memory stays constant however long the recording.
+    Frames are not stored; read the maps with maps() at any time.
+    '''
+
+    def __init__(self, dims, dtype):
+        '''
+        @param dims: Frame dimensions (height, width), see get_frame_dims()
+        @param dtype: Pixel dtype, see get_pixel_dtype()
+        '''
+        super().__init__()
+        self._lock = threading.Lock()
+        self.dims = tuple(dims)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(self.dims)) * self.dtype.itemsize
+        self.count = 0
+        self._mean = np.zeros(self.dims, dtype=np.float64)
+        self._m2 = np.zeros(self.dims, dtype=np.float64)
+        self._min = np.zeros(self.dims, dtype=self.dtype)
+        self._max = np.zeros(self.dims, dtype=self.dtype)
+        # Scratch buffers
+        self._x = np.empty(self.dims, dtype=np.float64)
+        self._delta = np.empty(self.dims, dtype=np.float64)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if len(b) != self.frame_bytes:
+            return len(b)  # Control frame
+        frame = np.frombuffer(b, dtype=self.dtype).reshape(self.dims)
+        with self._lock:
+            self.count += 1
+            if self.count == 1:
+                np.copyto(self._min, frame)
+                np.copyto(self._max, frame)
+            else:
+                np.minimum(self._min, frame, out=self._min)
+                np.maximum(self._max, frame, out=self._max)
+            x, delta = self._x, self._delta
+            np.copyto(x, frame, casting='unsafe')
+            np.subtract(x, self._mean, out=delta)
+            # mean += delta / n
+            np.multiply(delta, 1.0 / self.count, out=x)
+            np.add(self._mean, x, out=self._mean)
+            # m2 += delta * (x - mean), x reloaded from the frame
+            np.copyto(x, frame, casting='unsafe')
+            np.subtract(x, self._mean, out=x)
+            np.multiply(delta, x, out=x)
+            np.add(self._m2, x, out=self._m2)
+        return len(b)
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self._mean.fill(0)
+            self._m2.fill(0)
+
+    def maps(self):
+        '''
+        @return: dict of copies: 'count', 'mean', 'variance' (sample
+                 variance, nan below two frames), 'min' and 'max'
+        '''
+        with self._lock:
+            n = self.count
+            if n > 1:
+                variance = self._m2 / (n - 1)
+            else:
+                variance = np.full(self.dims, np.nan)
+            return {'count': n,
+                    'mean': self._mean.copy(),
+                    'variance': variance,
+                    'min': self._min.copy(),
+                    'max': self._max.copy()}
+
+
 # class XevaBufferedStream(io.BufferedRandom):
 #     def __init__(self, buffer_size=io.DEFAULT_BUFFER_SIZE):
 #         super().__init__(DataStream(), buffer_size=buffer_size)
@@ -5,14 +5,26 @@ Created on 23.11.2016
 '''
 
 import os
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import pylab
 import numpy as np
 import laserscan.xevacam.streams as streams
 import threading
 import time
 
+# Initial capacity of the frame time stamp buffer, grows by doubling
+TIMESTAMP_CHUNK = 4096
+# Frame time stamps are saved as a sidecar file, described in the ENVI header
+TIMESTAMP_DESCRIPTION = 'uint64 little-endian ns since start, sidecar file'
+# Camera window properties (GenICam names) used for hardware ROI,
+# in the order offset x, offset y, width, height
+ROI_PROPERTIES = ('OffsetX', 'OffsetY', 'Width', 'Height')
+# Sleep limits (s) while polling the camera for the next frame
+POLL_BACKOFF_MIN = 50e-6
+POLL_BACKOFF_MAX = 2e-3
+# DLL errors after which the camera handle has to be reopened
+HANDLE_ERRORS = ('E_INVALID_HANDLE', 'E_NOINIT')
+# Frames queued per handler by default, see delivery.HandlerQueue
+DELIVERY_QUEUE_SIZE = 32
+
 def datatype2envitype(datatype):
     DATATYPES = {'u1': 1,
                  'i2': 2,
@@ -67,7 +79,7 @@ class PreviewWindow(object):
         raise NotImplementedError()
 
     def close(self):
-        # pylab.close()
+        import matplotlib.pyplot as plt
         plt.close()
 
     def wait(self):
@@ -90,6 +102,8 @@ class RawPreviewWindow(PreviewWindow):
         self._window_thread.start()
 
     def show_thread(self, interval=60):
+        import matplotlib.pyplot as plt
+        import matplotlib.animation as animation
         self.fig = plt.figure()
         self.fig.canvas.set_window_title(self.title)
         im = plt.imshow(self._image(self.stream,
@@ -113,7 +127,7 @@ class RawPreviewWindow(PreviewWindow):
                                     updatefig,
                                     interval=60,
                                     blit=True)
-        pylab.show()
+        plt.show()
 
 
 class LineScanWindow(PreviewWindow):
@@ -134,6 +148,8 @@ class LineScanWindow(PreviewWindow):
         self._window_thread.start()
 
     def show_thread(self, layer_num, num_of_lines=500, interval=60):
+        import matplotlib.pyplot as plt
+        import matplotlib.animation as animation
         self.fig = plt.figure()
         #self.fig.canvas.set_window_title(self.title)
         canvas = np.zeros(
@@ -159,9 +175,8 @@ class LineScanWindow(PreviewWindow):
                                     updatefig,
                                     interval=60,
                                     blit=True)
-        pylab.show()
+        plt.show()
         print('Window thread closed')
-        plt
 
 
 def create_envi_hdr(meta, filepath, extra=None):
@@ -207,3 +222,29 @@ def kbinterrupt_decorate(func):
 def get_time():
     return int(round(time.time()*1000))
 
+
+def get_time_ns():
+    '''
+    Monotonic high resolution time stamp in nanoseconds.
+    Uses perf_counter_ns, since monotonic_ns has only tick (~16 ms)
+    resolution on Windows.
+    '''
+    return time.perf_counter_ns()
+
+
+def write_timestamps(timestamps, filepath):
+    '''
+    Writes frame time stamps as raw little-endian uint64 values.
+
+    @param timestamps: Sequence of time stamps in nanoseconds
+    @param filepath: Path of the sidecar file
+    '''
+    np.asarray(timestamps, dtype='<u8').tofile(filepath)
+
+
+def read_timestamps(filepath):
+    '''
+    Reads frame time stamps written by write_timestamps().
+    @return: Numpy uint64 array, nanoseconds
+    '''
+    return np.fromfile(filepath, dtype='<u8')
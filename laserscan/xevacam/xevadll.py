@@ -8,8 +8,7 @@ from sys import platform as sys_plat
 import pathlib
 import os, sys
 import ctypes
-from ctypes import windll, cdll, CDLL, WINFUNCTYPE, CFUNCTYPE, \
-                   c_void_p, c_int32, c_char_p, c_bool, c_ulong, \
+from ctypes import CDLL, c_void_p, c_int32, c_char_p, c_bool, c_ulong, \
                    create_string_buffer, c_uint, c_double
 
 
@@ -55,6 +54,35 @@ def get_property_info(handle, name):
     return name.value, value_resp.value, range_resp.value, unit_resp.value
 
 
+class PropertyBuffers(object):
+    '''
+    Reusable response buffers for reading many properties, instead of
+    allocating new ones per call as get_property_info() does.
+    '''
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.response = create_string_buffer(size)
+
+    def _call(self, func, handle, arg):
+        errCode = func(handle, arg, self.response, self.size)
+        if errCode:
+            raise Exception(error2str(errCode))
+        return self.response.value
+
+    def name(self, handle, idx):
+        return self._call(XDLL.get_property_name, handle, idx)
+
+    def value(self, handle, name):
+        return self._call(XDLL.get_property_value, handle, name)
+
+    def range(self, handle, name):
+        return self._call(XDLL.get_property_range, handle, name)
+
+    def unit(self, handle, name):
+        return self._call(XDLL.get_property_unit, handle, name)
+
+
 def set_num_property(handle, name, value, boolean = False):
     name = create_string_buffer(name)
 
@@ -115,7 +143,12 @@ class CDLLEx(ctypes.CDLL):
                                      use_errno, use_last_error)
 
 
-class WinDLLEx(ctypes.WinDLL):
+# WinDLL only exists on Windows, fall back so that the module imports
+# everywhere. The DLL itself is loaded on first use, see XDLL.load().
+_WinDLL = getattr(ctypes, 'WinDLL', CDLL)
+
+
+class WinDLLEx(_WinDLL):
     def __init__(self, name, mode=0, handle=None,
                  use_errno=False, use_last_error=True):
         if os.name == 'nt' and handle is None:
@@ -139,27 +172,99 @@ LOAD_LIBRARY_SEARCH_SYSTEM32 = 0x00000800
 LOAD_LIBRARY_SEARCH_DEFAULT_DIRS = 0x00001000
 
 
-class XDLL(object):
+# C function prototypes: attribute name -> (DLL symbol, restype, argtypes)
+# argtypes None leaves the arguments unchecked.
+_PROTOTYPES = {
+    # XCHANDLE XC_OpenCamera (const char * pCameraName = "cam://default",
+    #                         XStatus pCallBack = 0, void * pUser = 0);
+    'open_camera': ('XC_OpenCamera', c_int32, None),  # XCHANDLE
+    'error_to_string': ('XC_ErrorToString', c_int32,
+                        (c_int32, c_char_p, c_int32)),
+    'is_initialised': ('XC_IsInitialised', c_int32, (c_int32,)),
+    'start_capture': ('XC_StartCapture', c_ulong, (c_int32,)),  # ErrCode
+    'is_capturing': ('XC_IsCapturing', c_bool, (c_int32,)),
+    'get_frame_size': ('XC_GetFrameSize', c_ulong, (c_int32,)),
+    'get_frame_type': ('XC_GetFrameType', c_ulong, (c_int32,)),  # Enum
+    'get_frame_width': ('XC_GetWidth', c_ulong, (c_int32,)),
+    'get_frame_height': ('XC_GetHeight', c_ulong, (c_int32,)),
+    'get_frame': ('XC_GetFrame', c_ulong,  # ErrCode
+                  (c_int32, c_ulong, c_ulong, c_void_p, c_uint)),
+    'stop_capture': ('XC_StopCapture', c_ulong, (c_int32,)),  # ErrCode
+    'close_camera': ('XC_CloseCamera', None, (c_int32,)),  # Returns void
+    # Calibration
+    'load_calibration': ('XC_LoadCalibration', c_ulong, None),
+    # ColourProfile
+    'load_colour_profile': ('XC_LoadColourProfile', c_ulong, (c_char_p,)),
+    # Settings
+    'load_settings': ('XC_LoadSettings', c_ulong, (c_char_p, c_ulong)),
+    # Properties
+    'get_property_count': ('XC_GetPropertyCount', c_ulong, (c_int32,)),
+    'get_property_name': ('XC_GetPropertyName', c_ulong,
+                          (c_int32, c_uint, c_char_p, c_uint)),
+    'get_property_range': ('XC_GetPropertyRange', c_ulong,
+                           (c_int32, c_char_p, c_char_p, c_uint)),
+    'get_property_value': ('XC_GetPropertyValue', c_ulong,
+                           (c_int32, c_char_p, c_char_p, c_uint)),
+    'get_property_unit': ('XC_GetPropertyUnit', c_ulong,
+                          (c_int32, c_char_p, c_char_p, c_uint)),
+    'set_property_value': ('XC_SetPropertyValueF', c_ulong,
+                           (c_int32, c_char_p, c_double, c_char_p)),
+    'set_bool_property_value': ('XC_SetPropertyValueL', c_ulong,
+                                (c_int32, c_char_p, c_bool, c_char_p)),
+    'set_char_property_value': ('XC_SetPropertyValue', c_ulong,
+                                (c_int32, c_char_p, c_char_p, c_char_p)),
+}
+
+
+class _LazyDLLType(type):
+    '''
+    Metaclass resolving the C functions of XDLL on first access, so that
+    importing the package does not need the Xeneth runtime.
+    '''
+
+    def __getattr__(cls, name):
+        if name in _PROTOTYPES:
+            cls.load()
+            return type.__getattribute__(cls, name)
+        raise AttributeError(name)
+
+
+class XDLL(object, metaclass=_LazyDLLType):
     ''' Talks to xeneth64.dll '''
 
-    # ctypes.WinDLL('kernel32')
-    # directory = 'C:\\MyTemp\\envs\\xevacam\\Lib\\site-packages\\'
-    # directory = r'C:\Users\TMOS LAB\Desktop\XevaCamController\xevacam'
-    # directory = str(pathlib.Path(__file__).parent)
-    directory = r"C:\Program Files\Common Files\XenICs\Runtime"
-    if not pathlib.Path(directory).exists():
-        raise Exception(f"The expected directory for the xeneth DLL file not found in {directory}")
-    # directory = ''
-    # print(xenethC_path)
-    # os.chdir(directory)
-    # _xenethDLL = windll.LoadLibrary(os.path.join(directory, 'xeneth64.dll'))
+    # Runtime directory, can be overridden with XENETH_RUNTIME
+    directory = os.environ.get('XENETH_RUNTIME',
+                               r"C:\Program Files\Common Files\XenICs\Runtime")
 
     if sys.maxsize > 2**32:
         dllName = "xeneth64.dll"
     else:
         dllName = "xeneth.dll"
-    _xenethDLL = WinDLLEx(os.path.join(directory, dllName),
-                          LOAD_WITH_ALTERED_SEARCH_PATH)
+    _xenethDLL = None
+
+    @classmethod
+    def load(cls):
+        '''
+        Loads the DLL and binds the C functions as class attributes.
+        Called automatically on the first camera operation.
+        '''
+        if cls._xenethDLL is not None:
+            return
+        if not pathlib.Path(cls.directory).exists():
+            raise Exception(f"The expected directory for the xeneth DLL file not found in {cls.directory}")
+        dll = WinDLLEx(os.path.join(cls.directory, cls.dllName),
+                       LOAD_WITH_ALTERED_SEARCH_PATH)
+        for attr, (symbol, restype, argtypes) in _PROTOTYPES.items():
+            func = getattr(dll, symbol)
+            func.restype = restype
+            if argtypes is not None:
+                func.argtypes = argtypes
+            setattr(cls, attr, func)
+        cls._xenethDLL = dll
+
+    @classmethod
+    def is_loaded(cls):
+        return cls._xenethDLL is not None
 
     # C Enumerations
 
@@ -256,111 +361,3 @@ class XDLL(object):
     XLC_RFU_1 = 2
     XLC_RFU_2 = 4
     XLC_RFU_3 = 8
-
-    # C functions
-
-    # XCHANDLE XC_OpenCamera (const char * pCameraName = "cam://default",
-    #                         XStatus pCallBack = 0, void * pUser = 0);
-    open_camera = _xenethDLL.XC_OpenCamera
-    open_camera.restype = c_int32  # XCHANDLE
-    # open_camera.argtypes = (c_char_p,)
-    # open_camera.argtypes = (c_char_p, CB_FUNCTYPE(None), c_void_p)
-
-    error_to_string = _xenethDLL.XC_ErrorToString
-    error_to_string.restype = c_int32
-    error_to_string.argtypes = (c_int32, c_char_p, c_int32)
-
-    is_initialised = _xenethDLL.XC_IsInitialised
-    is_initialised.restype = c_int32
-    is_initialised.argtypes = (c_int32,)
-
-    start_capture = _xenethDLL.XC_StartCapture
-    start_capture.restype = c_ulong  # ErrCode
-    start_capture.argtypes = (c_int32,)
-
-    is_capturing = _xenethDLL.XC_IsCapturing
-    is_capturing.restype = c_bool
-    is_capturing.argtypes = (c_int32,)
-
-    get_frame_size = _xenethDLL.XC_GetFrameSize
-    get_frame_size.restype = c_ulong
-    get_frame_size.argtypes = (c_int32,)  # Handle
-
-    get_frame_type = _xenethDLL.XC_GetFrameType
-    get_frame_type.restype = c_ulong  # Returns enum
-    get_frame_type.argtypes = (c_int32,)  # Handle
-
-    get_frame_width = _xenethDLL.XC_GetWidth
-    get_frame_width.restype = c_ulong
-    get_frame_width.argtypes = (c_int32,)  # Handle
-
-    get_frame_height = _xenethDLL.XC_GetHeight
-    get_frame_height.restype = c_ulong
-    get_frame_height.argtypes = (c_int32,)  # Handle
-
-    get_frame = _xenethDLL.XC_GetFrame
-    get_frame.restype = c_ulong  # ErrCode
-    get_frame.argtypes = (c_int32, c_ulong, c_ulong, c_void_p, c_uint)
-
-    stop_capture = _xenethDLL.XC_StopCapture
-    stop_capture.restype = c_ulong  # ErrCode
-    stop_capture.argtypes = (c_int32,)
-
-    close_camera = _xenethDLL.XC_CloseCamera
-    # Returns void
-    close_camera.argtypes = (c_int32,)  # Handle
-
-    # Calibration
-    load_calibration = _xenethDLL.XC_LoadCalibration
-    load_calibration.restype = c_ulong  # ErrCode
-    # load_calibration.argtypes = (c_int32, c_char_p, c_ulong)
-
-    # ColourProfile
-    load_colour_profile = _xenethDLL.XC_LoadColourProfile
-    load_colour_profile.restype = c_ulong
-    load_colour_profile.argtypes = (c_char_p,)
-
-    # Settings
-    load_settings = _xenethDLL.XC_LoadSettings
-    load_settings.restype = c_ulong
-    load_settings.argtypes = (c_char_p, c_ulong)
-
-    # Property count getter
-    get_property_count = _xenethDLL.XC_GetPropertyCount
-    get_property_count.restype = c_ulong # ErrCode
-    get_property_count.argtypes = (c_int32,)
-
-    # Property name getter
-    get_property_name = _xenethDLL.XC_GetPropertyName
-    get_property_name.restype = c_ulong # ErrCode
-    get_property_name.argtypes = (c_int32, c_uint, c_char_p, c_uint)
-
-    # Property range getter
-    get_property_range = _xenethDLL.XC_GetPropertyRange
-    get_property_range.restype = c_ulong # ErrCode
-    get_property_range.argtypes = (c_int32, c_char_p, c_char_p, c_uint)
-
-    # Property value getter
-    get_property_value = _xenethDLL.XC_GetPropertyValue
-    get_property_value.restype = c_ulong # ErrCode
-    get_property_value.argtypes = (c_int32, c_char_p, c_char_p, c_uint)
-
-    # Property unit getter
-    get_property_unit = _xenethDLL.XC_GetPropertyUnit
-    get_property_unit.restype = c_ulong # ErrCode
-    get_property_unit.argtypes = (c_int32, c_char_p, c_char_p, c_uint)
-
-    # Property setter
-    set_property_value = _xenethDLL.XC_SetPropertyValueF
-    set_property_value.restype = c_ulong  # ErrCode
-    set_property_value.argtypes = (c_int32, c_char_p, c_double, c_char_p)
-
-    # Property setter (bool)
-    set_bool_property_value = _xenethDLL.XC_SetPropertyValueL
-    set_bool_property_value.restype = c_ulong  # ErrCode
-    set_bool_property_value.argtypes = (c_int32, c_char_p, c_bool, c_char_p)
-
-    # Property setter (characters)
-    set_char_property_value = _xenethDLL.XC_SetPropertyValue
-    set_char_property_value.restype = c_ulong  # ErrCode
-    set_char_property_value.argtypes = (c_int32, c_char_p, c_char_p, c_char_p)
@@ -1,6 +1,10 @@
 from laserscan.lasercontrol import LaserSource
 from laserscan.gui import LaserScanApp
 from laserscan.xevacam.camera import XevaCam
+from laserscan.xevacam.session import CameraSession
+from laserscan.xevacam.group import CameraGroup
+from laserscan.wavecal import WavelengthCalibration
+from laserscan.metrics import MetricsExporter, camera_collector, laser_collector
 import os
 from datetime import datetime
 
@@ -8,6 +12,7 @@ from datetime import datetime
 """ Launch the GUI - requires some customization to point to the correct Xeneth control software path """
 
 if __name__ == "__main__":
+    exporter = group = cam = None
     try:
         #Create a folder to hold the images and output the folder path.
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -26,13 +31,42 @@ if __name__ == "__main__":
         
         #initialize camera
         # cam = camera.XevaCam(calibration='none')
-        cam.start_capture(camera_path=r"cam://0", sw_correction=False)
-      
+        # The session keeps the handle open and reconnects after faults
+        cam = CameraSession(cam, camera_path=r"cam://0", sw_correction=False)
+        cam.open()
+
+        # Second camera for the reference arm, e.g. r"cam://1"
+        reference_path = None
+        if reference_path:
+            reference = CameraSession(XevaCam(), camera_path=reference_path,
+                                      sw_correction=False)
+            reference.open()
+            group = CameraGroup([("signal", cam), ("reference", reference)],
+                                output_dir)
+
+
+        # Metrics for unattended runs, set http_port to serve them locally
+        exporter = MetricsExporter(os.path.join(output_dir, "metrics.prom"),
+                                   interval=10.0, http_port=None)
+        exporter.add_collector(camera_collector(cam))
+        exporter.add_collector(laser_collector(laser))
+        exporter.start()
+
+        # Commanded vs measured wavelengths, one table per laser
+        calibration = WavelengthCalibration.for_laser(
+            os.path.join(script_dir, "calibrations"), "GPIB0::1::INSTR")
 
         # initialize GUI
-        app = LaserScanApp(laser, cam, output_dir)
+        app = LaserScanApp(laser, cam, output_dir, group=group,
+                           calibration=calibration)
         app.run()
 
     finally:
-        cam.close()
-        print("Camera closed.")
+        if exporter is not None:
+            exporter.stop()
+        if group is not None:
+            print(f"Camera skew: {group.skew_stats()}")
+            group.close()
+        if cam is not None:
+            cam.close()
+            print("Camera closed.")